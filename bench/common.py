@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+# Helpers shared by the benchmarks: load the dash-named scripts as modules and point them at local stand-ins
+
+import os
+import sys
+import time
+import types
+import importlib.util
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def load_script(name, mongo_url=None):
+    # The scripts need a tokens module; the benchmarks use a fake credential and, unless mongo_url is given, no real Mongo
+    sys.modules['tokens'] = types.SimpleNamespace(tokens={'bench': {'client_id': 'bench', 'client_secret': 'bench'}}, mongo_url=mongo_url)
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_').replace('.py', ''), os.path.join(root, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_mongo(worker, mongo_url=None):
+    # A worker Mongo backed by a real server, or by the in-memory stand-in
+    if mongo_url is not None:
+        return worker.Mongo()
+    import memory_mongo
+    mongo = worker.Mongo.__new__(worker.Mongo)
+    mongo.db = memory_mongo.MemoryClient()
+    mongo.indexed = set()
+    return mongo
+
+def report(label, count, unit, elapsed, size=None):
+    line = "[INFO] {label:12} {count:>10} {unit} in {elapsed:7.2f}s  {rate:10.1f} {unit}/s".format(label=label, count=count, unit=unit, elapsed=elapsed, rate=count / max(elapsed, 1e-9))
+    if size is not None:
+        line += "  {mb:8.2f} MB  {mbs:7.1f} MB/s".format(mb=size / 1e6, mbs=size / 1e6 / max(elapsed, 1e-9))
+    print(line)
+
+class Timer:
+    elapsed = 0
+    started = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.started
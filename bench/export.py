@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Export throughput (MB/s and docs/sec) of export-pvpdb.py on a synthetic collection
+# Usage: bench/export.py [characters] [--realms n] [--formats lua,compact] [--changed ratio] [--mongo-url url]
+#
+# Each format is exported in full, then incrementally after `--changed` of the characters were updated.
+
+import os
+import random
+import argparse
+import tempfile
+import pymongo
+
+import generate
+from common import Timer, load_script, get_mongo, report
+
+def main():
+    parser = argparse.ArgumentParser(description='Exporter throughput')
+    parser.add_argument('characters', type=int, nargs='?', default=100000)
+    parser.add_argument('--realms', type=int, default=250)
+    parser.add_argument('--formats', default='lua,compact')
+    parser.add_argument('--changed', type=float, default=0.01, help='share of characters updated before the incremental export')
+    parser.add_argument('--mongo-url')
+    args = parser.parse_args()
+
+    worker = load_script('worker-pvpdb.py', args.mongo_url)
+    export = load_script('export-pvpdb.py', args.mongo_url)
+    region, faction = 'bench', 'alliance'
+    mongo = get_mongo(worker, args.mongo_url)
+    db_characters = mongo.db['pvpdb']['characters_{r}_{f}'.format(r=region, f=faction)]
+    db_characters.drop()
+    mongo.ensure_indexes(db_characters)
+    with Timer() as timer:
+        generate.insert_characters(db_characters, generate.iter_characters(args.characters, args.realms, stale=False))
+    report('generate', args.characters, 'docs', timer.elapsed)
+
+    with tempfile.TemporaryDirectory() as path:
+        os.makedirs(os.path.join(path, 'db'))
+        export.addon_path = path
+        export.manifest_path = os.path.join(path, 'manifest_{region}_{faction}.json')
+        for export_format in args.formats.split(','):
+            with Timer() as timer:
+                export.export_characters(db_characters, region, faction, export_format)
+            report(export_format, args.characters, 'docs', timer.elapsed, os.path.getsize(export.characters_path(region, faction)))
+
+            # Touch a sample of characters, as an update run would
+            rng = random.Random(export_format)
+            ids = [c['_id'] for c in db_characters.find({}, {'_id': 1})]
+            ops = [pymongo.UpdateOne({'_id': _id}, {'$set': {'pvp-bracket.ARENA_2v2.current_statistics': {'rating': rng.randint(0, 3000), 'played': 1, 'won': 1, 'lost': 0}}, '$currentDate': {'lastModified': True, 'lastChanged': True}}) for _id in rng.sample(ids, int(len(ids) * args.changed))]
+            if len(ops) > 0:
+                db_characters.bulk_write(ops, ordered=False)
+            changed = len(ops)
+            with Timer() as timer:
+                export.export_characters_incremental(db_characters, region, faction, export_format)
+            report(export_format + ' incr', changed, 'docs', timer.elapsed, os.path.getsize(export.characters_path(region, faction)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compare the lua and compact export formats: file size, export time and, with lupa installed, addon load/lookup time
+# Usage: bench/export_format.py [characters] [realms]
+
+import os
+import sys
+import time
+import random
+import string
+
+from common import root, load_script
+
+def generate_realms(characters, realms):
+    random.seed(42)
+    data = {}
+    for i in range(characters):
+        realm = 'Realm{n}'.format(n=i % realms)
+        char = {'name': random.choice(string.ascii_uppercase) + ''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 11))) + str(i), 'realm': realm}
+        char['pvp-bracket'] = {}
+        for bracket_id in random.sample(['ARENA_2v2', 'ARENA_3v3', 'BATTLEGROUNDS'], random.randint(0, 3)):
+            won, lost = random.randint(0, 900), random.randint(0, 900)
+            char['pvp-bracket'][bracket_id] = {'current_statistics': {'rating': random.randint(0, 3000), 'played': won + lost, 'won': won, 'lost': lost}}
+        data.setdefault(realm, []).append(char)
+    return data
+
+def decode_compact(export, chunk):
+    # Python mirror of the Lua decoder, used to check the round trip
+    names, stats = chunk.split('={"', 1)[1].rsplit('"}', 1)[0].split('","')
+    digits = {c: i for i, c in enumerate(export.compact_alphabet)}
+    width = 9 * len(export.brackets)
+    decoded = {}
+    for i, name in enumerate(names.split(',') if names else []):
+        record = stats[i * width:(i + 1) * width]
+        values = [digits[record[j]] * 4096 + digits[record[j + 1]] * 64 + digits[record[j + 2]] for j in range(0, width, 3)]
+        decoded[name] = {}
+        for b, (bracket_id, bracket_slug) in enumerate(export.brackets):
+            if values[b * 3] != export.compact_missing:
+                decoded[name][bracket_slug] = values[b * 3:b * 3 + 3]
+    return decoded
+
+def export_file(export, export_format, data, path):
+    format_chunk, write = export.formats[export_format]
+    start = time.perf_counter()
+    with open(path, 'w', buffering=export.export_buffer_size) as f:
+        write(f, 'eu', 'alliance', (format_chunk('alliance', realm, data[realm]) for realm in sorted(data)))
+    return time.perf_counter() - start
+
+def lua_load(export, export_format, path, lookups):
+    try:
+        import lupa.lua51
+    except ImportError:
+        return None
+    lua = lupa.lua51.LuaRuntime()
+    lua.execute('''
+        ns = {REGION = "eu", dba = {}, dbh = {}}
+        function CreateFrame()
+            local frame = {}
+            function frame:RegisterEvent() end
+            function frame:UnregisterEvent() end
+            function frame:SetScript(event, handler) frame.handler = handler end
+            frames[#frames + 1] = frame
+            return frame
+        end
+        frames = {}
+    ''')
+    load = lua.eval('function(code) local chunk = assert(loadstring(code)); chunk("PvPDB", ns) end')
+    if export_format == 'compact':
+        load(export.compact_runtime.replace('{alphabet}', export.compact_alphabet).replace('{missing}', str(export.compact_missing)))
+    with open(path, 'r') as f:
+        code = f.read()
+    start = time.perf_counter()
+    load(code)
+    lua.execute('for _, frame in ipairs(frames) do frame.handler(frame, "PLAYER_ENTERING_WORLD") end')
+    loaded = time.perf_counter() - start
+    lookup = lua.eval('function(realm, name) local c = ns.dba[realm][name]; return c and c["2v2"] and c["2v2"][1] end')
+    start = time.perf_counter()
+    ratings = [lookup(realm, name) for realm, name in lookups]
+    looked_up = time.perf_counter() - start
+    memory = lua.eval('(function() collectgarbage("collect"); return collectgarbage("count") end)()')
+    return loaded, looked_up, memory, ratings
+
+def main():
+    characters = int(sys.argv[1]) if len(sys.argv) >= 2 else 100000
+    realms = int(sys.argv[2]) if len(sys.argv) >= 3 else 250
+    export = load_script('export-pvpdb.py')
+    data = generate_realms(characters, realms)
+    random.seed(1)
+    sample = random.sample([c for r in data.values() for c in r], min(1000, characters))
+    lookups = [(c['realm'], c['name']) for c in sample]
+    expected_ratings = [c['pvp-bracket'].get('ARENA_2v2', {}).get('current_statistics', {}).get('rating') for c in sample]
+
+    # Round trip check of the compact encoding
+    for realm in list(data)[:5]:
+        decoded = decode_compact(export, export.format_realm_compact('alliance', realm, data[realm]))
+        for char in data[realm]:
+            expected = {slug: [s['rating'], s['won'], s['lost']] for bracket_id, slug in export.brackets for s in [char['pvp-bracket'].get(bracket_id, {}).get('current_statistics')] if s}
+            assert decoded.get(char['name'], {}) == expected, char['name']
+
+    print("[INFO] {characters} characters in {realms} realms".format(characters=characters, realms=realms))
+    for export_format in ['lua', 'compact']:
+        path = os.path.join(root, 'db', 'bench_{f}.lua'.format(f=export_format))
+        elapsed = export_file(export, export_format, data, path)
+        size = os.path.getsize(path)
+        print("[INFO] {f:8} {size:8.2f} MB  export {elapsed:6.2f}s  {rate:6.1f} MB/s".format(f=export_format, size=size / 1e6, elapsed=elapsed, rate=size / 1e6 / elapsed))
+        timings = lua_load(export, export_format, path, lookups)
+        if timings is None:
+            print("[WARN] Install lupa to benchmark the addon load and lookups")
+        else:
+            assert timings[3] == expected_ratings, "Lua lookups do not match the exported data"
+            print("[INFO] {f:8} load {load:6.3f}s  {n} lookups {lookup:6.3f}s  Lua memory {memory:8.1f} KB".format(f=export_format, load=timings[0], n=len(lookups), lookup=timings[1], memory=timings[2]))
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the Blizzard OAuth, pvp-season, pvp-summary and pvp-bracket endpoints
+# Usage: bench/fake_api.py [port] [--latency ms] [--rate-429 r] [--rate-503 r] [--rate-404 r] [--payload bytes] [--active r]
+#
+# URLs mirror the real API with the region host moved into the path:
+#   POST /oauth/token
+#   GET  /{region}/data/wow/pvp-season/index
+#   GET  /{region}/profile/wow/character/{realm}/{name}/pvp-summary
+#   GET  /{region}/profile/wow/character/{realm}/{name}/pvp-bracket/{2v2|3v3|rbg}
+#   GET  /stats
+
+import re
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+import http.server
+import email.utils
+
+bracket_types = {'2v2': 'ARENA_2v2', '3v3': 'ARENA_3v3', 'rbg': 'BATTLEGROUNDS'}
+summary_path = re.compile(r'^/(\w+)/profile/wow/character/([^/]+)/([^/]+)/pvp-summary$')
+bracket_path = re.compile(r'^/(\w+)/profile/wow/character/([^/]+)/([^/]+)/pvp-bracket/(\w+)$')
+season_path = re.compile(r'^/(\w+)/data/wow/pvp-season/index$')
+
+class Options:
+    latency = 0.05
+    jitter = 0.5
+    rate_429 = 0.0
+    rate_503 = 0.0
+    rate_404 = 0.0
+    retry_after = 1
+    payload = 2000
+    active = 0.2
+    season = 30
+    expires_in = 86399
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if value is not None:
+                setattr(self, name, value)
+
+def character_seed(realm, name):
+    return zlib.crc32('{realm}/{name}'.format(realm=realm, name=name).encode('utf-8'))
+
+def character_brackets(realm, name):
+    # Stable per character: which brackets it played and its base statistics
+    rng = random.Random(character_seed(realm, name))
+    played = [slug for slug in bracket_types if rng.random() < 0.5]
+    return {slug: (rng.randint(0, 3000), rng.randint(0, 400), rng.randint(0, 400)) for slug in played}
+
+class FakeApi:
+    options = None
+    server = None
+    thread = None
+    stats = None
+    stats_lock = None
+    started = None
+
+    def count(self, endpoint, code):
+        with self.stats_lock:
+            key = '{endpoint} {code}'.format(endpoint=endpoint, code=code)
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def is_active(self, realm, name):
+        return character_seed(realm, name) % 1000 < self.options.active * 1000
+
+    def last_modified(self, realm, name):
+        # Active characters change at every request, the others have not played since the server started
+        if self.is_active(realm, name):
+            return time.time()
+        return self.started
+
+    def summary(self, base, region, realm, name):
+        links = [{'href': '{base}/{region}/profile/wow/character/{realm}/{name}/pvp-bracket/{slug}?namespace=profile-{region}'.format(base=base, region=region, realm=realm, name=name, slug=slug)} for slug in character_brackets(realm, name)]
+        return {
+            '_links': {'self': {'href': '{base}/{region}/profile/wow/character/{realm}/{name}/pvp-summary'.format(base=base, region=region, realm=realm, name=name)}},
+            'character': {'name': name.capitalize(), 'realm': {'slug': realm}},
+            'honor_level': character_seed(realm, name) % 500,
+            'brackets': links,
+            'pvp_map_statistics': 'x' * self.options.payload
+        }
+
+    def bracket(self, realm, name, slug):
+        stats = character_brackets(realm, name)
+        if slug not in stats:
+            return None
+        rating, won, lost = stats[slug]
+        if self.is_active(realm, name):
+            # A game played since the previous request
+            won += int(time.time() * 10) % 7
+        return {
+            'bracket': {'id': list(bracket_types).index(slug), 'type': bracket_types[slug]},
+            'rating': rating,
+            'season': {'id': self.options.season},
+            'season_match_statistics': {'played': won + lost, 'won': won, 'lost': lost},
+            'weekly_match_statistics': {'played': 0, 'won': 0, 'lost': 0},
+            'tier': 'x' * (self.options.payload // 4)
+        }
+
+    def handler(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, Nagle would hold the body for the delayed ACK
+            disable_nagle_algorithm = True
+
+            def reply(self, endpoint, code, body=None, headers=None):
+                api.count(endpoint, code)
+                data = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if body is not None:
+                    self.send_header('Content-Type', 'application/json;charset=UTF-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def simulate(self, endpoint):
+                # Latency and injected errors, True when the request was already answered
+                options = api.options
+                if options.latency > 0:
+                    time.sleep(options.latency * random.uniform(1 - options.jitter, 1 + options.jitter))
+                roll = random.random()
+                if roll < options.rate_429:
+                    self.reply(endpoint, 429, {'code': 429, 'type': 'BLZWEBAPI00000429', 'detail': 'Too Many Requests'}, {'Retry-After': str(options.retry_after)})
+                elif roll < options.rate_429 + options.rate_503:
+                    self.reply(endpoint, 503, {'code': 503, 'detail': 'Service Unavailable'})
+                elif roll < options.rate_429 + options.rate_503 + options.rate_404:
+                    self.reply(endpoint, 404, {'code': 404, 'type': 'BLZWEBAPI00000404', 'detail': 'Not Found'})
+                else:
+                    return False
+                return True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.split('?')[0] == '/oauth/token':
+                    self.reply('oauth', 200, {'access_token': 'bench-{n}'.format(n=random.getrandbits(32)), 'token_type': 'bearer', 'expires_in': api.options.expires_in})
+                else:
+                    self.reply('other', 404, {'code': 404})
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                base = 'http://{host}'.format(host=self.headers.get('Host'))
+                if path == '/stats':
+                    with api.stats_lock:
+                        stats = dict(api.stats)
+                    return self.reply('stats', 200, stats)
+                m = season_path.match(path)
+                if m:
+                    return self.reply('pvp-season', 200, {'current_season': {'id': api.options.season}})
+                m = summary_path.match(path)
+                if m:
+                    region, realm, name = m.groups()
+                    if self.simulate('pvp-summary'):
+                        return
+                    return self.conditional('pvp-summary', realm, name, lambda: api.summary(base, region, realm, name))
+                m = bracket_path.match(path)
+                if m:
+                    region, realm, name, slug = m.groups()
+                    if self.simulate('pvp-bracket'):
+                        return
+                    return self.conditional('pvp-bracket', realm, name, lambda: api.bracket(realm, name, slug))
+                self.reply('other', 404, {'code': 404})
+
+            def conditional(self, endpoint, realm, name, body):
+                modified = api.last_modified(realm, name)
+                since = self.headers.get('If-Modified-Since')
+                if since is not None and email.utils.parsedate_to_datetime(since).timestamp() >= int(modified):
+                    return self.reply(endpoint, 304)
+                data = body()
+                if data is None:
+                    return self.reply(endpoint, 404, {'code': 404, 'detail': 'Not Found'})
+                self.reply(endpoint, 200, data, {'Last-Modified': email.utils.formatdate(modified, usegmt=True)})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def url(self):
+        return 'http://127.0.0.1:{port}'.format(port=self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __init__(self, port=0, options=None):
+        self.options = options or Options()
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.started = time.time() - 3600
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, help='mean response time in ms (50)')
+    parser.add_argument('--rate-429', type=float, help='share of 429 responses (0)')
+    parser.add_argument('--rate-503', type=float, help='share of 503 responses (0)')
+    parser.add_argument('--rate-404', type=float, help='share of 404 responses (0)')
+    parser.add_argument('--retry-after', type=int, help='Retry-After of the 429 responses, in seconds (1)')
+    parser.add_argument('--payload', type=int, help='padding bytes of the summary responses (2000)')
+    parser.add_argument('--active', type=float, help='share of characters whose statistics change between fetches (0.2)')
+
+def options_from(args):
+    return Options(latency=args.latency / 1000 if args.latency is not None else None, rate_429=args.rate_429, rate_503=args.rate_503, rate_404=args.rate_404, retry_after=args.retry_after, payload=args.payload, active=args.active)
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Blizzard API for the pvpdb benchmarks')
+    parser.add_argument('port', type=int, nargs='?', default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    api = FakeApi(args.port, options_from(args))
+    print("[INFO] Fake Blizzard API on {url}".format(url=api.url()))
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        api.stop()
+
+if __name__ == '__main__':
+    main()
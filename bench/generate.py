@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Synthetic RaiderIO files and character collections, deterministic for a given size
+# Usage:
+#   bench/generate.py rio <characters> [--realms n] [--dir path] [--region r] [--faction f]
+#   bench/generate.py mongo <characters> --mongo-url url [--realms n] [--region r] [--faction f]
+#
+# Characters are spread evenly over the realms and generated realm by realm, so 10^7 characters never sit in memory.
+# The mongo command fills pvpdb.characters_{region}_{faction}, with region "bench" by default to stay clear of real data.
+
+import os
+import sys
+import random
+import string
+import argparse
+import datetime
+
+from common import Timer, report
+
+brackets = ['ARENA_2v2', 'ARENA_3v3', 'BATTLEGROUNDS']
+
+def realm_name(r):
+    return 'Realm{r}'.format(r=r)
+
+def realm_slugs(realms):
+    return {realm_name(r): 'realm{r}'.format(r=r) for r in range(realms)}
+
+def realm_size(characters, realms, r):
+    return characters // realms + (1 if r < characters % realms else 0)
+
+def character_name(rng, n):
+    # Random prefix, and n in base 26 so that names are unique in a realm
+    suffix = ''
+    while True:
+        suffix = string.ascii_lowercase[n % 26] + suffix
+        n //= 26
+        if n == 0:
+            break
+    return rng.choice(string.ascii_uppercase) + ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 6))) + suffix
+
+def iter_realm_names(characters, realms, seed=42):
+    # (realm, [names]) for each realm
+    for r in range(realms):
+        rng = random.Random(seed * 1000003 + r)
+        yield realm_name(r), [character_name(rng, n) for n in range(realm_size(characters, realms, r))]
+
+def iter_characters(characters, realms, seed=42, stale=True):
+    # Collection documents as left by init (stale=True) or by a past update, with statistics
+    rng = random.Random(seed)
+    d = datetime.datetime(1970, 1, 1)
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    for realm, names in iter_realm_names(characters, realms, seed):
+        for name in names:
+            doc = {'name': name, 'realm': realm, 'lastModified': d, 'nextRefresh': d}
+            if not stale:
+                doc['lastModified'] = now - datetime.timedelta(days=rng.randint(1, 30))
+                doc['nextRefresh'] = now + datetime.timedelta(days=rng.randint(1, 30))
+                doc['honor_level'] = rng.randint(0, 500)
+                doc['pvp-bracket'] = {}
+                for bracket_id in rng.sample(brackets, rng.randint(0, 3)):
+                    won, lost = rng.randint(0, 400), rng.randint(0, 400)
+                    doc['pvp-bracket'][bracket_id] = {'current_statistics': {'rating': rng.randint(0, 3000), 'played': won + lost, 'won': won, 'lost': lost}}
+            yield doc
+
+def write_rio(path, region, faction, characters, realms, seed=42):
+    # rio/db_realms.lua and rio/db_{region}_{faction}_characters.lua in the RaiderIO layout read by the worker
+    os.makedirs(os.path.join(path, 'rio'), exist_ok=True)
+    with open(os.path.join(path, 'rio', 'db_realms.lua'), 'w') as f:
+        f.write('local _, ns = ...\n')
+        f.write('ns.realmSlugs = {\n')
+        for realm, slug in realm_slugs(realms).items():
+            f.write('["{realm}"] = "{slug}",\n'.format(realm=realm, slug=slug))
+        f.write('}\n')
+    characters_file = os.path.join(path, 'rio', 'db_{region}_{faction}_characters.lua'.format(region=region, faction=faction))
+    with open(characters_file, 'w') as f:
+        f.write('local provider = {{name=..., data=1, region="{region}", faction={faction}}}\n'.format(region=region, faction=1 if faction == 'alliance' else 2))
+        f.write('local F\n\n')
+        for realm, names in iter_realm_names(characters, realms, seed):
+            f.write('F = function() provider.db["{realm}"]={{0,{names}}} end F()\n'.format(realm=realm, names=','.join('"{n}"'.format(n=n) for n in names)))
+    return characters_file
+
+def insert_characters(db_characters, docs, chunk_size=10000):
+    inserted = 0
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            inserted += len(db_characters.insert_many(chunk, ordered=False).inserted_ids)
+            chunk = []
+    if len(chunk) > 0:
+        inserted += len(db_characters.insert_many(chunk, ordered=False).inserted_ids)
+    return inserted
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic pvpdb data')
+    parser.add_argument('target', choices=['rio', 'mongo'])
+    parser.add_argument('characters', type=int)
+    parser.add_argument('--realms', type=int, default=250)
+    parser.add_argument('--region', default='bench')
+    parser.add_argument('--faction', default='alliance')
+    parser.add_argument('--dir', default='.')
+    parser.add_argument('--mongo-url')
+    parser.add_argument('--stale', action='store_true', help='documents as left by init, without statistics')
+    args = parser.parse_args()
+    with Timer() as timer:
+        if args.target == 'rio':
+            path = write_rio(args.dir, args.region, args.faction, args.characters, args.realms)
+            size = os.path.getsize(path)
+            count = args.characters
+        else:
+            if args.mongo_url is None:
+                print("[ERROR] --mongo-url is required to fill a collection")
+                sys.exit(1)
+            import pymongo
+            db_characters = pymongo.MongoClient(args.mongo_url)['pvpdb']['characters_{r}_{f}'.format(r=args.region, f=args.faction)]
+            count = insert_characters(db_characters, iter_characters(args.characters, args.realms, stale=args.stale))
+            size = None
+    report('generate', count, 'docs', timer.elapsed, size)
+
+if __name__ == '__main__':
+    main()
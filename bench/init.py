@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Init throughput (docs/sec): parse a synthetic RaiderIO file and insert it into a character collection
+# Usage: bench/init.py [characters] [--realms n] [--chunk-size n] [--mongo-url url]
+#
+# The second pass inserts the same file again, every document is then rejected by the unique name/realm index.
+
+import os
+import argparse
+import tempfile
+
+import generate
+from common import Timer, load_script, get_mongo, report
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker init throughput')
+    parser.add_argument('characters', type=int, nargs='?', default=100000)
+    parser.add_argument('--realms', type=int, default=250)
+    parser.add_argument('--chunk-size', type=int)
+    parser.add_argument('--mongo-url')
+    args = parser.parse_args()
+
+    worker = load_script('worker-pvpdb.py', args.mongo_url)
+    if args.chunk_size:
+        worker.init_chunk_size = args.chunk_size
+    region, faction = 'bench', 'alliance'
+    mongo = get_mongo(worker, args.mongo_url)
+    db_characters = mongo.db['pvpdb']['characters_{r}_{f}'.format(r=region, f=faction)]
+    db_characters.drop()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        with Timer() as timer:
+            characters_file = generate.write_rio(path, region, faction, args.characters, args.realms)
+        report('generate', args.characters, 'docs', timer.elapsed, os.path.getsize(characters_file))
+        os.chdir(path)
+        try:
+            w = worker.Worker('bench', region, faction, mongo=mongo, realm_slug=worker.generate_realm_slug('rio/db_realms.lua'))
+            for label in ['insert', 'duplicates']:
+                with Timer() as timer:
+                    w.init_characters()
+                report(label, args.characters, 'docs', timer.elapsed, os.path.getsize(characters_file))
+        finally:
+            os.chdir(cwd)
+    assert db_characters.estimated_document_count() == args.characters
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+
+# In-memory stand-in for the pymongo operations used by the worker and the exporter
+# Collections are plain dicts scanned linearly: fine up to ~10^5 documents, use a real mongod above that
+
+import copy
+import datetime
+import threading
+import bson
+import pymongo
+import pymongo.errors
+
+missing = object()
+
+def get_path(doc, path):
+    for part in path.split('.'):
+        if isinstance(doc, dict) and part in doc:
+            doc = doc[part]
+        else:
+            return missing
+    return doc
+
+def set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+def unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+def comparable(a, b):
+    # Mongo only orders values of the same type bracket
+    numbers = (int, float)
+    if isinstance(a, numbers) and isinstance(b, numbers):
+        return not isinstance(a, bool) and not isinstance(b, bool)
+    return type(a) == type(b)
+
+def compare(op, value, arg):
+    if op == '$in':
+        return any(compare('$eq', value, a) for a in arg)
+    elif op == '$nin':
+        return not compare('$in', value, arg)
+    elif op == '$exists':
+        return (value is not missing) == bool(arg)
+    elif op == '$eq':
+        if arg is None:
+            return value is missing or value is None
+        return value == arg
+    elif op == '$ne':
+        return not compare('$eq', value, arg)
+    if value is missing or value is None or not comparable(value, arg):
+        return False
+    return {'$lt': value < arg, '$lte': value <= arg, '$gt': value > arg, '$gte': value >= arg}[op]
+
+def match(doc, query):
+    for key, cond in query.items():
+        if key == '$or':
+            if not any(match(doc, q) for q in cond):
+                return False
+        elif key == '$and':
+            if not all(match(doc, q) for q in cond):
+                return False
+        elif isinstance(cond, dict) and len(cond) > 0 and all(k.startswith('$') for k in cond):
+            value = get_path(doc, key)
+            if not all(compare(op, value, arg) for op, arg in cond.items()):
+                return False
+        elif not compare('$eq', get_path(doc, key), cond):
+            return False
+    return True
+
+def project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    included = [k for k, v in projection.items() if v and k != '_id']
+    if len(included) == 0:
+        doc = copy.deepcopy(doc)
+        for k, v in projection.items():
+            if not v:
+                unset_path(doc, k)
+        return doc
+    result = {}
+    if projection.get('_id', 1) and '_id' in doc:
+        result['_id'] = doc['_id']
+    for path in included:
+        value = get_path(doc, path)
+        if value is not missing:
+            set_path(result, path, copy.deepcopy(value))
+    return result
+
+def sort_key(value):
+    # null and missing first, then numbers, strings and dates as Mongo does
+    if value is missing or value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime.datetime):
+        return (3, value)
+    return (4, str(value))
+
+def apply_update(doc, update, insert=False):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == '$set' or (op == '$setOnInsert' and insert):
+                set_path(doc, path, copy.deepcopy(value))
+            elif op == '$unset':
+                unset_path(doc, path)
+            elif op == '$inc':
+                current = get_path(doc, path)
+                set_path(doc, path, (0 if current is missing else current) + value)
+            elif op == '$currentDate':
+                now = datetime.datetime.utcnow()
+                set_path(doc, path, now.replace(microsecond=now.microsecond // 1000 * 1000))
+            elif op == '$push':
+                current = get_path(doc, path)
+                if current is missing:
+                    current = []
+                    set_path(doc, path, current)
+                current.extend(copy.deepcopy(value['$each']) if isinstance(value, dict) and '$each' in value else [copy.deepcopy(value)])
+            elif op != '$setOnInsert':
+                raise NotImplementedError(op)
+
+class Result:
+    acknowledged = True
+
+    def __init__(self, **fields):
+        self.inserted_ids = []
+        self.matched_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.upserted_id = None
+        self.__dict__.update(fields)
+
+class MemoryCursor:
+    collection = None
+    query = None
+    projection = None
+    sorting = None
+    skipped = 0
+    limited = 0
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        self.sorting = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, n):
+        self.skipped = n
+        return self
+
+    def limit(self, n):
+        self.limited = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def __iter__(self):
+        with self.collection.lock:
+            docs = [doc for doc in self.collection.candidates(self.query) if match(doc, self.query)]
+            for key, direction in reversed(self.sorting or []):
+                docs.sort(key=lambda doc: sort_key(get_path(doc, key)), reverse=direction == pymongo.DESCENDING)
+            docs = docs[self.skipped:]
+            if self.limited:
+                docs = docs[:self.limited]
+            docs = [project(doc, self.projection) for doc in docs]
+        return iter(docs)
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+
+class MemoryCollection:
+    name = None
+    database = None
+    docs = None
+    indexes = None
+    unique = None
+    lock = None
+
+    def candidates(self, query):
+        # Lookups by _id, as the worker's writes and claims do, skip the scan
+        _id = query.get('_id', missing)
+        if isinstance(_id, dict) and list(_id) == ['$in']:
+            return [self.docs[i] for i in _id['$in'] if i in self.docs]
+        elif _id is not missing and not isinstance(_id, dict):
+            return [self.docs[_id]] if _id in self.docs else []
+        return list(self.docs.values())
+
+    def index_key(self, name, doc):
+        return tuple(repr(get_path(doc, k)) for k, d in self.indexes[name]['key'])
+
+    def index_add(self, doc, previous=None):
+        # Unique indexes map their key to the _id holding it
+        keys = {name: self.index_key(name, doc) for name in self.unique}
+        for name, key in keys.items():
+            if self.unique[name].get(key, doc['_id']) != doc['_id']:
+                raise pymongo.errors.DuplicateKeyError("E11000 duplicate key error collection: {c} index: {i}".format(c=self.name, i=name), 11000)
+        if previous is not None:
+            self.index_remove(previous)
+        for name, key in keys.items():
+            self.unique[name][key] = doc['_id']
+
+    def index_remove(self, doc):
+        for name in self.unique:
+            self.unique[name].pop(self.index_key(name, doc), None)
+
+    def insert(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault('_id', bson.ObjectId())
+        if doc['_id'] in self.docs:
+            raise pymongo.errors.DuplicateKeyError("E11000 duplicate key error collection: {c} index: _id_".format(c=self.name), 11000)
+        self.index_add(doc)
+        self.docs[doc['_id']] = doc
+        return doc['_id']
+
+    def insert_one(self, doc):
+        with self.lock:
+            return Result(inserted_id=self.insert(doc))
+
+    def insert_many(self, docs, ordered=True):
+        inserted, errors = [], []
+        with self.lock:
+            for i, doc in enumerate(docs):
+                try:
+                    inserted.append(self.insert(doc))
+                except pymongo.errors.DuplicateKeyError as e:
+                    errors.append({'index': i, 'code': 11000, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if len(errors) > 0:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted)})
+        return Result(inserted_ids=inserted)
+
+    def update(self, query, update, upsert=False, many=False):
+        result = Result()
+        for doc in self.candidates(query):
+            if match(doc, query):
+                updated = copy.deepcopy(doc)
+                apply_update(updated, update)
+                self.index_add(updated, previous=doc)
+                self.docs[doc['_id']] = updated
+                result.matched_count += 1
+                result.modified_count += int(updated != doc)
+                if not many:
+                    break
+        if result.matched_count == 0 and upsert:
+            doc = {k: v for k, v in query.items() if not k.startswith('$') and not isinstance(v, dict)}
+            apply_update(doc, update, insert=True)
+            result.upserted_id = self.insert(doc)
+        return result
+
+    def replace(self, query, replacement, upsert=False):
+        result = Result()
+        docs = [doc for doc in self.candidates(query) if match(doc, query)]
+        if len(docs) > 0:
+            updated = copy.deepcopy(replacement)
+            updated['_id'] = docs[0]['_id']
+            self.index_add(updated, previous=docs[0])
+            self.docs[updated['_id']] = updated
+            result.matched_count = result.modified_count = 1
+        elif upsert:
+            doc = copy.deepcopy(replacement)
+            if '_id' not in doc and not isinstance(query.get('_id', {}), dict):
+                doc['_id'] = query['_id']
+            result.upserted_id = self.insert(doc)
+        return result
+
+    def replace_one(self, query, replacement, upsert=False):
+        with self.lock:
+            return self.replace(query, replacement, upsert)
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            return self.update(query, update, upsert)
+
+    def update_many(self, query, update, upsert=False):
+        with self.lock:
+            return self.update(query, update, upsert, many=True)
+
+    def find_one_and_update(self, query, update, upsert=False, sort=None, return_document=False):
+        with self.lock:
+            docs = [doc for doc in self.candidates(query) if match(doc, query)]
+            for key, direction in reversed(sort or []):
+                docs.sort(key=lambda doc: sort_key(get_path(doc, key)), reverse=direction == pymongo.DESCENDING)
+            before = copy.deepcopy(docs[0]) if len(docs) > 0 else None
+            result = self.update({'_id': docs[0]['_id']} if before else query, update, upsert=upsert and before is None)
+            if return_document:
+                _id = before['_id'] if before else result.upserted_id
+                return copy.deepcopy(self.docs.get(_id))
+            return before
+
+    def delete(self, query, many=False):
+        result = Result()
+        for doc in self.candidates(query):
+            if match(doc, query):
+                del self.docs[doc['_id']]
+                self.index_remove(doc)
+                result.deleted_count += 1
+                if not many:
+                    break
+        return result
+
+    def delete_one(self, query):
+        with self.lock:
+            return self.delete(query)
+
+    def delete_many(self, query):
+        with self.lock:
+            return self.delete(query, many=True)
+
+    def bulk_write(self, ops, ordered=True):
+        # pymongo operation objects keep their arguments in private attributes
+        result = Result(inserted_count=0)
+        errors = []
+        with self.lock:
+            for i, op in enumerate(ops):
+                try:
+                    if isinstance(op, pymongo.InsertOne):
+                        self.insert(op._doc)
+                        result.inserted_count += 1
+                    elif isinstance(op, (pymongo.UpdateOne, pymongo.UpdateMany)):
+                        r = self.update(op._filter, op._doc, op._upsert, many=isinstance(op, pymongo.UpdateMany))
+                        result.matched_count += r.matched_count
+                        result.modified_count += r.modified_count
+                    elif isinstance(op, pymongo.ReplaceOne):
+                        r = self.replace(op._filter, op._doc, op._upsert)
+                        result.matched_count += r.matched_count
+                        result.modified_count += r.modified_count
+                    elif isinstance(op, (pymongo.DeleteOne, pymongo.DeleteMany)):
+                        result.deleted_count += self.delete(op._filter, many=isinstance(op, pymongo.DeleteMany)).deleted_count
+                    else:
+                        raise NotImplementedError(type(op).__name__)
+                except pymongo.errors.DuplicateKeyError as e:
+                    errors.append({'index': i, 'code': 11000, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if len(errors) > 0:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors, 'nInserted': result.inserted_count})
+        return result
+
+    def find(self, query=None, projection=None):
+        return MemoryCursor(self, query, projection)
+
+    def find_one(self, query=None, projection=None, sort=None):
+        cursor = self.find(query, projection).limit(1)
+        if sort:
+            cursor.sort(sort)
+        return next(iter(cursor), None)
+
+    def count_documents(self, query, limit=0):
+        with self.lock:
+            count = sum(1 for doc in self.candidates(query) if match(doc, query))
+        return min(count, limit) if limit else count
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+    def distinct(self, key, query=None):
+        values = []
+        for doc in self.find(query, {key: 1}):
+            value = get_path(doc, key)
+            if value is not missing and value not in values:
+                values.append(value)
+        return values
+
+    def index_information(self):
+        return copy.deepcopy(self.indexes)
+
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        keys = [(keys, pymongo.ASCENDING)] if isinstance(keys, str) else list(keys)
+        name = name or '_'.join('{k}_{d}'.format(k=k, d=d) for k, d in keys)
+        with self.lock:
+            index = {'key': keys}
+            if unique:
+                index['unique'] = True
+            self.indexes[name] = index
+            if unique:
+                self.unique[name] = {}
+                for doc in self.docs.values():
+                    self.index_add(doc)
+        return name
+
+    def create_indexes(self, models):
+        return [self.create_index(list(model.document['key'].items()), **{k: v for k, v in model.document.items() if k != 'key'}) for model in models]
+
+    def drop(self):
+        with self.lock:
+            self.docs.clear()
+            self.indexes = {'_id_': {'key': [('_id', pymongo.ASCENDING)]}}
+            self.unique = {}
+
+    def __init__(self, name, database=None):
+        self.name = name
+        self.database = database
+        self.docs = {}
+        self.indexes = {'_id_': {'key': [('_id', pymongo.ASCENDING)]}}
+        self.unique = {}
+        self.lock = threading.RLock()
+
+class MemoryDatabase:
+    collections = None
+    lock = None
+
+    def list_collection_names(self):
+        return list(self.collections)
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = MemoryCollection(name, self)
+            return self.collections[name]
+
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+class MemoryClient:
+    databases = None
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, MemoryDatabase())
+
+    def __init__(self):
+        self.databases = {}
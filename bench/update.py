@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Update throughput (characters/sec) of the worker against the fake Blizzard API
+# Usage: bench/update.py [characters] [--realms n] [--concurrency n] [--sync] [--passes n] [--mongo-url url] [fake API options]
+#
+# The first pass fetches every character; later passes make them stale again and go through the conditional (304) path,
+# where unchanged characters only get their schedule written.
+# With --mongo-url the collection is pvpdb.characters_bench_alliance on that server, otherwise the in-memory stand-in.
+
+import os
+import argparse
+import datetime
+
+import fake_api
+import generate
+from common import Timer, load_script, get_mongo, report
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker update throughput')
+    parser.add_argument('characters', type=int, nargs='?', default=2000)
+    parser.add_argument('--realms', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--sync', action='store_true', help='run update_characters instead of update_characters_async')
+    parser.add_argument('--passes', type=int, default=2)
+    parser.add_argument('--rate-per-second', type=int, default=100000, help='client side rate limit of the worker')
+    parser.add_argument('--mongo-url')
+    fake_api.add_arguments(parser)
+    args = parser.parse_args()
+
+    api = fake_api.FakeApi(0, fake_api.options_from(args)).start()
+    worker = load_script('worker-pvpdb.py', args.mongo_url)
+    worker.token_url = api.url() + '/oauth/token'
+    worker.season_url = api.url() + '/{region}/data/wow/pvp-season/index?namespace={namespace}'
+    worker.pvp_summary_url = api.url() + '/{region}/profile/wow/character/{realm}/{character}/pvp-summary?namespace={namespace}'
+    worker.force_https = False
+    worker.api_rate_per_second = args.rate_per_second
+    worker.api_rate_per_hour = args.rate_per_second * 3600
+    worker.update_concurrency = args.concurrency
+    # requests-oauthlib refuses to fetch a token over plain http otherwise
+    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+    region, faction = 'bench', 'alliance'
+    mongo = get_mongo(worker, args.mongo_url)
+    db_characters = mongo.db['pvpdb']['characters_{r}_{f}'.format(r=region, f=faction)]
+    db_characters.drop()
+    db_history = mongo.db['pvpdb']['history_{r}_{f}'.format(r=region, f=faction)]
+    db_history.drop()
+    generate.insert_characters(db_characters, generate.iter_characters(args.characters, args.realms))
+    w = worker.Worker('bench', region, faction, mongo=mongo, oauth=worker.Oauth('bench'), realm_slug=generate.realm_slugs(args.realms))
+
+    print("[INFO] {n} characters in {realms} realms, {mode}".format(n=args.characters, realms=args.realms, mode='sync' if args.sync else 'async x{c}'.format(c=args.concurrency)))
+    results = []
+    for i in range(args.passes):
+        if i > 0:
+            db_characters.update_many({}, {'$set': {'nextRefresh': datetime.datetime(1970, 1, 1)}})
+        started = datetime.datetime.utcnow()
+        with Timer() as timer:
+            if args.sync:
+                w.update_characters()
+            else:
+                w.update_characters_async(args.concurrency)
+        changed = db_characters.count_documents({'lastChanged': {'$gte': started}})
+        results.append(('pass {n}'.format(n=i + 1), w.progress['done'], timer.elapsed, changed))
+    for label, done, elapsed, changed in results:
+        report(label, done, 'chars', elapsed)
+        print("[INFO]   {changed} characters with changed statistics".format(changed=changed))
+    with api.stats_lock:
+        for key, count in sorted(api.stats.items()):
+            print("[INFO]   {key:20} {count:>8}".format(key=key, count=count))
+    print("[INFO] {n} season history entries".format(n=db_history.estimated_document_count()))
+    api.stop()
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ import time
 import datetime
 import requests
 import signal
+import hashlib
+import itertools
+import multiprocessing
 import pymongo
 from pymongo import MongoClient
 from requests_oauthlib import OAuth2Session
@@ -34,9 +37,19 @@ except ImportError:
     sys.exit(1)
 
 debug = False
+export_processes = 8
+export_buffer_size = 1 << 20
+brackets = [('ARENA_2v2', '2v2'), ('ARENA_3v3', '3v3'), ('BATTLEGROUNDS', 'bg')]
+manifest_path = "db/export_manifest_{region}_{faction}.json"
+realm_line = re.compile(r'^(?:F = function\(\) ns\.db[a-z]|R)\["(.*?)"\]=')
+# Compact format: 3 base64 digits per value, rating/won/lost for each bracket
+compact_alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+compact_missing = 64 ** 3 - 1
 
-client = pymongo.MongoClient(tokens.mongo_url)
-pvpdb = client['pvpdb']
+def get_pvpdb():
+    # One client per process, MongoClient is not fork-safe
+    client = pymongo.MongoClient(tokens.mongo_url)
+    return client['pvpdb']
 
 def export_realms(db_characters, region):
     print("[INFO] Export realms {region}".format(region=region))
@@ -49,49 +62,328 @@ def export_realms(db_characters, region):
             for faction in ["a", "h"]:
                 f.write('F = function() ns.db{faction}["{realm}"]={{}} end; F()\n'.format(faction=faction[:1], realm=realm))
 
-def export_characters(db_characters, region, faction):
-    print("[INFO] Export {region}-{faction}".format(region=region, faction=faction))
-    realms = db_characters.distinct('realm')
-    with open('{path}/db/db_characters_{region}_{faction}.lua'.format(path=addon_path, region=region, faction=faction), 'w') as f:
+def format_character(char):
+    stats = []
+    for bracket_id, bracket_slug in brackets:
+        if bracket_id in char.get('pvp-bracket', {}) and 'current_statistics' in char['pvp-bracket'][bracket_id]:
+            char_bracket = char['pvp-bracket'][bracket_id]['current_statistics']
+            stats.append('["{bracket_slug}"]={{{cr},{won},{lost}}}'.format(bracket_slug=bracket_slug, cr=char_bracket['rating'], won=char_bracket['won'], lost=char_bracket['lost']))
+    if len(stats) == 0:
+        return None
+    return '["{name}"]={{{stats}}}'.format(name=char['name'], stats=','.join(stats))
+
+def format_realm(faction, realm, characters):
+    chars = [c for c in map(format_character, characters) if c is not None]
+    return 'F = function() ns.db{faction}["{realm}"]={{{chars}}} end; F()\n'.format(faction=faction[:1], realm=realm, chars=','.join(chars))
+
+def compact_value(n):
+    n = min(max(int(n), 0), compact_missing - 1)
+    return compact_alphabet[n >> 12] + compact_alphabet[(n >> 6) & 63] + compact_alphabet[n & 63]
+
+def format_character_compact(char):
+    stats = []
+    for bracket_id, bracket_slug in brackets:
+        if bracket_id in char.get('pvp-bracket', {}) and 'current_statistics' in char['pvp-bracket'][bracket_id]:
+            char_bracket = char['pvp-bracket'][bracket_id]['current_statistics']
+            stats.append(compact_value(char_bracket['rating']) + compact_value(char_bracket['won']) + compact_value(char_bracket['lost']))
+        else:
+            stats.append(compact_alphabet[-1] * 3 + compact_value(0) * 2)
+    if all(s.startswith(compact_alphabet[-1] * 3) for s in stats):
+        return None
+    return ''.join(stats)
+
+def format_realm_compact(faction, realm, characters):
+    # Names are sorted bytewise so that the addon can binary search them
+    records = []
+    for char in characters:
+        stats = format_character_compact(char)
+        if stats is not None:
+            records.append((char['name'], stats))
+    records.sort(key=lambda r: r[0].encode('utf-8'))
+    return 'R["{realm}"]={{"{names}","{stats}"}}\n'.format(realm=realm, names=','.join(r[0] for r in records), stats=''.join(r[1] for r in records))
+
+def characters_projection():
+    projection = {'_id': 0, 'name': 1, 'realm': 1}
+    projection.update({'pvp-bracket.{b}.current_statistics'.format(b=bracket_id): 1 for bracket_id, bracket_slug in brackets})
+    return projection
+
+def stream_realms(db_characters):
+    # Single pass over the collection, sorted through the realm index, current statistics only
+    characters = db_characters.find({}, characters_projection()).sort('realm', pymongo.ASCENDING).batch_size(10000)
+    return itertools.groupby(characters, key=lambda c: c['realm'])
+
+def characters_path(region, faction):
+    return '{path}/db/db_characters_{region}_{faction}.lua'.format(path=addon_path, region=region, faction=faction)
+
+def realm_hash(chunk):
+    return hashlib.sha1(chunk.encode('utf-8')).hexdigest()
+
+def load_manifest(region, faction):
+    try:
+        with open(manifest_path.format(region=region, faction=faction), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+def save_manifest(region, faction, last_export, realms, export_format):
+    with open(manifest_path.format(region=region, faction=faction), 'w') as f:
+        json.dump({'last_export': last_export.isoformat(), 'format': export_format, 'realms': realms}, f, sort_keys=True)
+
+def write_characters(f, region, faction, chunks):
+    f.write('local _, ns = ...\n')
+    f.write('local region = "{region}"\n'.format(region=region))
+    f.write('local F\n\n')
+    f.write('local function Load(self, event, ...)\n')
+    for chunk in chunks:
+        f.write(chunk)
+    f.write('end\n')
+    f.write('local Load_Frame = CreateFrame("FRAME")\n')
+    f.write('if region == ns.REGION then\n')
+    f.write('    Load_Frame:RegisterEvent("PLAYER_ENTERING_WORLD")\n')
+    f.write('    Load_Frame:SetScript("OnEvent", Load)\n')
+    f.write('end\n')
+
+def write_characters_compact(f, region, faction, chunks):
+    f.write('local _, ns = ...\n')
+    f.write('local region = "{region}"\n'.format(region=region))
+    f.write('local R = {}\n\n')
+    for chunk in chunks:
+        f.write(chunk)
+    f.write('local Load_Frame = CreateFrame("FRAME")\n')
+    f.write('if region == ns.REGION then\n')
+    f.write('    Load_Frame:RegisterEvent("PLAYER_ENTERING_WORLD")\n')
+    f.write('    Load_Frame:SetScript("OnEvent", function(self)\n')
+    f.write('        self:UnregisterEvent("PLAYER_ENTERING_WORLD")\n')
+    f.write('        ns.CompactDB(ns.db{faction}, R)\n'.format(faction=faction[:1]))
+    f.write('    end)\n')
+    f.write('end\n')
+
+compact_runtime = '''local _, ns = ...
+
+local ALPHABET = "{alphabet}"
+local MISSING = {missing}
+local SLUGS = {"2v2", "3v3", "bg"}
+local WIDTH = 9 * #SLUGS
+local byte, floor, gmatch = string.byte, math.floor, string.gmatch
+
+local D = {}
+for i = 1, #ALPHABET do
+    D[byte(ALPHABET, i)] = i - 1
+end
+
+local function Value(stats, pos)
+    local a, b, c = byte(stats, pos, pos + 2)
+    return D[a] * 4096 + D[b] * 64 + D[c]
+end
+
+local function Character(stats, index)
+    local character = {}
+    local pos = (index - 1) * WIDTH + 1
+    for i = 1, #SLUGS do
+        local cr = Value(stats, pos)
+        if cr ~= MISSING then
+            character[SLUGS[i]] = {cr, Value(stats, pos + 3), Value(stats, pos + 6)}
+        end
+        pos = pos + 9
+    end
+    return character
+end
+
+local function Realm(packed)
+    local names, stats = {}, packed[2]
+    for name in gmatch(packed[1], "[^,]+") do
+        names[#names + 1] = name
+    end
+    return setmetatable({}, {__index = function(realm, name)
+        local lo, hi = 1, #names
+        while lo <= hi do
+            local mid = floor((lo + hi) / 2)
+            local n = names[mid]
+            if n == name then
+                local character = Character(stats, mid)
+                rawset(realm, name, character)
+                return character
+            elseif n < name then
+                lo = mid + 1
+            else
+                hi = mid - 1
+            end
+        end
+    end})
+end
+
+function ns.CompactDB(db, realms)
+    setmetatable(db, {__index = function(db, name)
+        local packed = realms[name]
+        if packed then
+            local realm = Realm(packed)
+            rawset(db, name, realm)
+            realms[name] = nil
+            return realm
+        end
+    end})
+end
+'''
+
+def write_compact_runtime():
+    # Decoder shared by the compact files, realms are decoded the first time a tooltip reads them
+    with open('{path}/db/db_compact.lua'.format(path=addon_path), 'w') as f:
+        f.write(compact_runtime.replace('{alphabet}', compact_alphabet).replace('{missing}', str(compact_missing)))
+
+percentiles_runtime = '''
+local BUCKET = {bucket}
+local TOP = {{{top}}}
+local ALPHABET = "{alphabet}"
+local byte, floor, min = string.byte, math.floor, math.min
+
+local D = {{}}
+for i = 1, #ALPHABET do
+    D[byte(ALPHABET, i)] = i - 1
+end
+
+-- Share of the region's characters rated below `rating` in `bracket` (0-100),
+-- and the best realm tier reached, e.g. 10 for the realm's top 10%
+function ns.RatingPercentile(bracket, rating, realm)
+    local tables = P[ns.REGION] and P[ns.REGION][bracket]
+    if not tables or not rating then
+        return
+    end
+    local curve = tables[1]
+    local pos = min(floor(rating / BUCKET), #curve / 3 - 1) * 3 + 1
+    local a, b, c = byte(curve, pos, pos + 2)
+    local below = (D[a] * 4096 + D[b] * 64 + D[c]) / 100
+    local cutoffs, top = realm and tables[2][realm]
+    if cutoffs then
+        for i = #cutoffs, 1, -1 do
+            if rating >= cutoffs[i] then
+                top = TOP[i]
+                break
+            end
+        end
+    end
+    return below, top
+end
+'''
+
+def format_percentile_curve(counts):
+    # For each bucket, the share of characters in the buckets below, in 1/100 of a percent
+    total, below, curve = sum(counts), 0, []
+    for n in counts:
+        curve.append(compact_value(below * 10000 // total))
+        below += n
+    curve.append(compact_value(10000))
+    return ''.join(curve)
+
+def export_percentiles(pvpdb):
+    # Tables precomputed by percentile-pvpdb.py: one curve per region and bracket, cutoff ratings per realm
+    tables = {}
+    for doc in pvpdb['percentiles'].find({'total': {'$gt': 0}}).sort('_id', pymongo.ASCENDING):
+        tables.setdefault((doc['region'], doc['bracket']), {'curve': None, 'realms': []})
+        if doc['realm'] is None:
+            tables[(doc['region'], doc['bracket'])]['curve'] = doc
+        else:
+            tables[(doc['region'], doc['bracket'])]['realms'].append(doc)
+    tables = {key: table for key, table in tables.items() if table['curve'] is not None}
+    if len(tables) == 0:
+        print("[WARN] No percentile tables, run percentile-pvpdb.py first")
+        return False
+    print("[INFO] Export percentiles")
+    first = next(iter(tables.values()))['curve']
+    with open('{path}/db/db_percentiles.lua'.format(path=addon_path), 'w') as f:
         f.write('local _, ns = ...\n')
-        f.write('local region = "{region}"\n'.format(region=region))
-        f.write('local F\n\n')
-        f.write('local function Load(self, event, ...)\n')
-        for realm in realms:
-            f.write('F = function() ns.db{faction}["{realm}"]={{'.format(faction=faction[:1], realm=realm))
-            characters = db_characters.find({'realm': realm})
-            i = 0
-            for char in characters:
-                j = 0
-                #if 'honor_level' in char:
-                #    if j == 0:
-                #        f.write('["{name}"]={{'.format(name=char['name']))
-                #    f.write('["hl"]={hl}'.format(hl=char['honor_level']))
-                #    j += 1
-                if 'pvp-bracket' in char:
-                    for bracket_id, bracket_slug in ('ARENA_2v2', '2v2'), ('ARENA_3v3', '3v3'), ('BATTLEGROUNDS', 'bg'):
-                        if bracket_id in char['pvp-bracket'] and 'current_statistics' in char['pvp-bracket'][bracket_id]:
-                            if j == 0:
-                                if i != 0:
-                                    f.write(',')
-                                i += 1
-                                f.write('["{name}"]={{'.format(name=char['name']))
-                            else:
-                                f.write(',')
-                            j += 1
-                            char_bracket = char['pvp-bracket'][bracket_id]['current_statistics']
-                            f.write('["{bracket_slug}"]={{{cr},{won},{lost}}}'.format(bracket_slug=bracket_slug,cr=char_bracket['rating'],won=char_bracket['won'], lost=char_bracket['lost']))
-                if j != 0:
-                    f.write('}')
-            f.write('} end; F()\n')
-        f.write('end\n')
-        f.write('local Load_Frame = CreateFrame("FRAME")\n')
-        f.write('if region == ns.REGION then\n')
-        f.write('    Load_Frame:RegisterEvent("PLAYER_ENTERING_WORLD")\n')
-        f.write('    Load_Frame:SetScript("OnEvent", Load)\n')
-        f.write('end\n')
-
-def update_toc():
+        f.write('local P = {}\n\n')
+        for region in sorted(set(region for region, bracket in tables)):
+            f.write('P["{region}"] = {{}}\n'.format(region=region))
+        for (region, bracket), table in sorted(tables.items()):
+            realms = ','.join('["{realm}"]={{{cutoffs}}}'.format(realm=doc['realm'], cutoffs=','.join(str(rating) for percentile, rating in doc['cutoffs'])) for doc in table['realms'])
+            f.write('P["{region}"]["{bracket}"]={{"{curve}",{{{realms}}}}}\n'.format(region=region, bracket=bracket, curve=format_percentile_curve(table['curve']['counts']), realms=realms))
+        f.write(percentiles_runtime.format(bucket=first['bucket'], top=','.join('{:g}'.format(round(100 - percentile, 6)) for percentile, rating in first['cutoffs']), alphabet=compact_alphabet))
+    return True
+
+formats = {
+    'lua': (format_realm, write_characters),
+    'compact': (format_realm_compact, write_characters_compact)
+}
+
+def export_characters(db_characters, region, faction, export_format='lua'):
+    print("[INFO] Export {region}-{faction} ({export_format})".format(region=region, faction=faction, export_format=export_format))
+    format_chunk, write = formats[export_format]
+    # lastChanged is written by the server with $currentDate, in UTC
+    started = datetime.datetime.utcnow()
+    realms = {}
+    def chunks():
+        for realm, characters in stream_realms(db_characters):
+            chunk = format_chunk(faction, realm, characters)
+            realms[realm] = realm_hash(chunk)
+            yield chunk
+    with open(characters_path(region, faction), 'w', buffering=export_buffer_size) as f:
+        write(f, region, faction, chunks())
+    save_manifest(region, faction, started, realms, export_format)
+
+def read_chunks(path):
+    # Realm chunks of a previous export, one line per realm
+    chunks = {}
+    with open(path, 'r') as f:
+        for line in f:
+            m = realm_line.match(line)
+            if m:
+                chunks[m.group(1)] = line
+    return chunks
+
+def export_characters_incremental(db_characters, region, faction, export_format='lua'):
+    manifest = load_manifest(region, faction)
+    path = characters_path(region, faction)
+    if manifest is None or not os.path.exists(path):
+        print("[INFO] No previous export for {region}-{faction}, running a full export".format(region=region, faction=faction))
+        return export_characters(db_characters, region, faction, export_format)
+    if manifest.get('format', 'lua') != export_format:
+        print("[INFO] Export format changed for {region}-{faction}, running a full export".format(region=region, faction=faction))
+        return export_characters(db_characters, region, faction, export_format)
+    format_chunk, write = formats[export_format]
+    started = datetime.datetime.utcnow()
+    last_export = datetime.datetime.fromisoformat(manifest['last_export'])
+    realms = manifest['realms']
+    changed = {}
+    # Realms with a character whose statistics moved, lastModified for documents written before lastChanged existed
+    changed_since = {'$or': [{'lastChanged': {'$gt': last_export}}, {'lastChanged': None, 'lastModified': {'$gt': last_export}}]}
+    candidates = set(db_characters.distinct('realm', changed_since))
+    # and realms that lost characters, as recorded by the worker next to its deletes
+    db_deleted = db_characters.database['deleted_{r}_{f}'.format(r=region, f=faction)]
+    candidates.update(d['_id'] for d in db_deleted.find({'deleted': {'$gt': last_export}}, {'_id': 1}))
+    removed = []
+    for realm in sorted(candidates):
+        if db_characters.find_one({'realm': realm}, {'_id': 1}) is None:
+            # Not written at all by a full export
+            if realm in realms:
+                removed.append(realm)
+            continue
+        characters = db_characters.find({'realm': realm}, characters_projection())
+        chunk = format_chunk(faction, realm, characters)
+        if realms.get(realm) != realm_hash(chunk):
+            changed[realm] = chunk
+    print("[INFO] Export {region}-{faction}: {n} realms changed since {d}".format(region=region, faction=faction, n=len(changed) + len(removed), d=manifest['last_export']))
+    if len(changed) > 0 or len(removed) > 0:
+        chunks = read_chunks(path)
+        chunks.update(changed)
+        for realm in removed:
+            chunks.pop(realm, None)
+            del realms[realm]
+        with open(path + '.tmp', 'w', buffering=export_buffer_size) as f:
+            write(f, region, faction, (chunks[realm] for realm in sorted(chunks)))
+        os.replace(path + '.tmp', path)
+        realms.update({realm: realm_hash(chunk) for realm, chunk in changed.items()})
+    save_manifest(region, faction, started, realms, export_format)
+
+def export_collection(args):
+    region, faction, incremental, export_format = args
+    pvpdb = get_pvpdb()
+    db_characters = pvpdb['characters_{r}_{f}'.format(r=region, f=faction)]
+    if incremental:
+        export_characters_incremental(db_characters, region, faction, export_format)
+    else:
+        export_characters(db_characters, region, faction, export_format)
+
+def update_toc(export_format='lua', percentiles=False):
     with open('{path}/PvPDB.toc'.format(path=addon_path), 'w') as f:
         f.write('## Interface: 90002\n')
         f.write('## Title: PvPDB\n')
@@ -100,14 +392,28 @@ def update_toc():
         f.write('## Notes: Show PvP ranking information on tooltips\n\n')
 
         f.write('PvPDB.lua\n')
+        if export_format == 'compact':
+            f.write('db/db_compact.lua\n')
+        if percentiles:
+            f.write('db/db_percentiles.lua\n')
         for r in ["eu", "us", "kr", "tw"]:
             for faction in ["alliance", "horde"]:
                 f.write('db/db_characters_{r}_{faction}.lua\n'.format(r=r, faction=faction))
 
 def main():
-    for r in ["eu", "us", "kr", "tw"]:
-        for f in ["alliance", "horde"]:
-            export_characters(pvpdb['characters_{r}_{f}'.format(r=r, f=f)], r, f)
-    update_toc()
+    # export-pvpdb.py [full|incremental] [lua|compact]
+    incremental = len(sys.argv) >= 2 and sys.argv[1] == "incremental"
+    export_format = sys.argv[2] if len(sys.argv) >= 3 else 'lua'
+    if export_format not in formats:
+        print("[ERROR] Unknown export format {export_format}, use one of {formats}".format(export_format=export_format, formats=', '.join(formats)))
+        sys.exit(1)
+    collections = [(r, f, incremental, export_format) for r in ["eu", "us", "kr", "tw"] for f in ["alliance", "horde"]]
+    with multiprocessing.Pool(export_processes) as pool:
+        pool.map(export_collection, collections)
+    if export_format == 'compact':
+        write_compact_runtime()
+    percentiles = export_percentiles(get_pvpdb())
+    update_toc(export_format, percentiles)
 
-main()
+if __name__ == '__main__':
+    main()
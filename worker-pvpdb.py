@@ -9,6 +9,16 @@ import time
 import datetime
 import requests
 import signal
+import socket
+import random
+import threading
+import email.utils
+import urllib.parse
+import asyncio
+import contextlib
+import http.server
+import concurrent.futures
+import multiprocessing
 import pymongo
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2 import BackendApplicationClient
@@ -19,13 +29,89 @@ slug_url = "https://{region}.api.blizzard.com/data/wow/realm/index?namespace={na
 pvp_summary_url = "https://{region}.api.blizzard.com/profile/wow/character/{realm}/{character}/pvp-summary?namespace={namespace}"
 token_url = 'https://eu.battle.net/oauth/token'
 season_url = "https://{region}.api.blizzard.com/data/wow/pvp-season/index?namespace={namespace}"
+# The API links brackets over http://, they are fetched over https:// unless pointed at a local stand-in
+force_https = True
 character_days_ttl = 7
+# Refresh scheduler: active or high rated characters come back within hours, dormant ones back off to weeks
+refresh_min_hours = 4
+refresh_active_hours = 24
+refresh_max_hours = 24 * 42
+# Failed fetches are retried after refresh_retry_hours, doubled at each consecutive failure up to refresh_max_hours
+refresh_retry_hours = 1
+refresh_high_rating = 2100
+update_concurrency = 32
+claim_batch_size = 100
+claim_lease_minutes = 30
+init_chunk_size = 10000
+init_processes = 8
+# supervise: wait before restarting a crashed worker, and before polling again when there is no backlog
+supervise_restart_seconds = 60
+supervise_idle_seconds = 3600
+supervise_poll_seconds = 5
+supervise_stop_seconds = 120
+# Prometheus text endpoint on 127.0.0.1, supervised workers use the following ports.
+# When the port is taken, metrics are written to metrics_file instead
+metrics_port = 9108
+metrics_file = "db/metrics-{name}.prom"
+metrics_dump_seconds = 15
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Seconds between two progress lines
+log_interval = 1
+# Blizzard API quotas, per client
+api_rate_per_second = 100
+api_rate_per_hour = 36000
+api_max_retries = 5
+api_backoff_base = 1
+api_backoff_max = 600
+# Refresh the OAuth token this many seconds before it expires
+token_refresh_margin = 300
+# Season history: 'collection' appends changes to history_{region}_{faction}, 'document' keeps the legacy s{season}_statistics subdocuments
+season_history = 'collection'
+# Same slugs as the export and percentile tables
+history_brackets = {'ARENA_2v2': '2v2', 'ARENA_3v3': '3v3', 'BATTLEGROUNDS': 'bg'}
+migrate_chunk_size = 1000
+# Priority lookups: any running worker serves those of every region/faction, checking every lookup_poll_seconds, results cached for lookup_cache_seconds
+lookup_batch_size = 10
+lookup_lease_seconds = 60
+# Lookups of a character leased by a bulk worker are tried again after this delay
+lookup_retry_seconds = 5
+lookup_cache_seconds = 300
+lookup_pending_seconds = 3600
+lookup_poll_seconds = 1
+lookup_timeout_seconds = 60
+lookup_backlog_weight = 1000
 
 def usage():
     print('Usage:')
     print('  worker-pvpdb.py <init> <worker-id> : Init database from RaiderIO files')
     print('  worker-pvpdb.py <update> <worker-id> : Update database from Blizzard API')
+    print('  worker-pvpdb.py <update-async> <worker-id> [concurrency] : Update database with concurrent API calls')
     print('  worker-pvpdb.py <insert> <worker-id> <region> <faction> <realm> <name> : Insert a single character')
+    print('  worker-pvpdb.py <supervise> [concurrency] : Run one update worker per credential of tokens.py')
+    print('  worker-pvpdb.py <lookup> <region> <faction> <realm> <name> [timeout] : Fetch a character ahead of the backlog')
+    print('  worker-pvpdb.py <migrate-history> : Move s{season}_statistics subdocuments to the history collections')
+    print('  worker-pvpdb.py <leaderboard> <region> <faction> <season> <2v2|3v3|bg> [limit] : Highest ratings of a season')
+
+def generate_realm_slug(file):
+    with open(file, "r") as f:
+        data = f.read()
+        data = data.replace("local _, ns = ...", "")
+        data = data.replace("ns.realmSlugs = ", "")
+        data = data.replace("[", "")
+        data = data.replace("]", "")
+        data = data.replace(" =", ":")
+        data = data.replace(",\n}", "}")
+    return json.loads(data)
+
+def stale_filter(now):
+    # Characters without nextRefresh yet fall back to the character_days_ttl rule
+    d = now + datetime.timedelta(days=-character_days_ttl)
+    return {
+        "$and": [
+            {"$or": [{"nextRefresh": { "$lte": now }}, {"nextRefresh": None, "lastModified": { "$lte": d }}]},
+            {"$or": [{"leaseUntil": None}, {"leaseUntil": { "$lte": now }}]}
+        ]
+    }
 
 class GracefulKiller:
     kill_now = False
@@ -36,32 +122,248 @@ class GracefulKiller:
     def exit_gracefully(self,signum, frame):
         self.kill_now = True
 
+class Metrics:
+    counters = None
+    gauges = None
+    histograms = None
+    lock = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            # One counter per bucket, then sum and count
+            histogram = self.histograms.setdefault(key, [0] * (len(latency_buckets) + 2))
+            for i, bucket in enumerate(latency_buckets):
+                if value <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join('{k}="{v}"'.format(k=k, v=v) for k, v in labels) + '}'
+        lines = []
+        types = set()
+        def format_type(name, metric_type):
+            if name not in types:
+                types.add(name)
+                lines.append('# TYPE {name} {metric_type}'.format(name=name, metric_type=metric_type))
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                format_type(name, 'counter')
+                lines.append('{name}{labels} {value}'.format(name=name, labels=format_labels(labels), value=value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                format_type(name, 'gauge')
+                lines.append('{name}{labels} {value}'.format(name=name, labels=format_labels(labels), value=value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                format_type(name, 'histogram')
+                for i, bucket in enumerate(latency_buckets):
+                    lines.append('{name}_bucket{labels} {value}'.format(name=name, labels=format_labels(labels, [('le', bucket)]), value=histogram[i]))
+                lines.append('{name}_bucket{labels} {value}'.format(name=name, labels=format_labels(labels, [('le', '+Inf')]), value=histogram[-1]))
+                lines.append('{name}_sum{labels} {value}'.format(name=name, labels=format_labels(labels), value=histogram[-2]))
+                lines.append('{name}_count{labels} {value}'.format(name=name, labels=format_labels(labels), value=histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def start(self, name, port):
+        # Serve /metrics, or fall back to a stats file refreshed in the background
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        try:
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            print("[INFO] Metrics for {name} on http://127.0.0.1:{port}/metrics".format(name=name, port=port))
+        except OSError as e:
+            path = metrics_file.format(name=name)
+            print("[WARN] Metrics port {port} unavailable ({e}), writing {path}".format(port=port, e=e.strerror, path=path))
+            def dump_loop():
+                while True:
+                    time.sleep(metrics_dump_seconds)
+                    self.dump(path)
+            threading.Thread(target=dump_loop, daemon=True).start()
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+metrics = Metrics()
+
+def api_endpoint(url):
+    path = urllib.parse.urlsplit(url).path
+    for endpoint in ['pvp-summary', 'pvp-bracket', 'pvp-season']:
+        if endpoint in path:
+            return endpoint
+    return 'other'
+
+class TokenBucket:
+    rate = None
+    capacity = None
+    tokens = None
+    timestamp = None
+    lock = None
+
+    def reserve(self):
+        # Take a token, possibly on credit, and return the seconds to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+class RateLimiter:
+    buckets = None
+    paused_until = 0
+    lock = None
+
+    def acquire(self):
+        wait = max(bucket.reserve() for bucket in self.buckets)
+        with self.lock:
+            pause = self.paused_until - time.monotonic()
+        if max(wait, pause) > 0:
+            time.sleep(max(wait, pause))
+
+    def pause(self, seconds):
+        # Throttled by the API: hold back every caller sharing this client
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def __init__(self, per_second, per_hour):
+        self.buckets = [
+            TokenBucket(per_second, per_second),
+            TokenBucket(per_hour / 3600, per_hour)
+        ]
+        self.lock = threading.Lock()
+
+def backoff_delay(attempt, res=None):
+    if res is not None and 'Retry-After' in res.headers:
+        retry_after = res.headers['Retry-After']
+        try:
+            return min(api_backoff_max, max(0, float(retry_after)))
+        except ValueError:
+            try:
+                date = email.utils.parsedate_to_datetime(retry_after)
+                return min(api_backoff_max, max(0, (date - datetime.datetime.now(date.tzinfo)).total_seconds()))
+            except (TypeError, ValueError):
+                pass
+    return min(api_backoff_max, api_backoff_base * 2 ** attempt) + random.uniform(0, api_backoff_base)
+
 class Oauth:
     client_id = None
     client_secret = None
     oauth_client = None
     token = None
+    token_expires = 0
+    token_lock = None
+    sessions = None
+    sessions_lock = None
+    limiter = None
 
     def oauth_login(self, client):
         oauth = OAuth2Session(client=client)
-        return oauth.fetch_token(token_url=token_url, client_id=self.client_id, client_secret=self.client_secret)
+        with metrics.timer('pvpdb_api_latency_seconds', endpoint='oauth'):
+            return oauth.fetch_token(token_url=token_url, client_id=self.client_id, client_secret=self.client_secret)
 
-    def oauth_api_call(self, url):
+    def get_access_token(self, expired=None):
+        # Renew the token shortly before expires_in runs out, or when the API rejected `expired`
+        with self.token_lock:
+            if self.token is None or time.time() >= self.token_expires - token_refresh_margin or self.token['access_token'] == expired:
+                self.token = self.oauth_login(self.oauth_client)
+                self.token_expires = time.time() + self.token.get('expires_in', 86400)
+            return self.token['access_token']
+
+    def get_session(self, url):
+        # One keep-alive session per API host, e.g. eu.api.blizzard.com
+        host = urllib.parse.urlsplit(url).netloc
+        with self.sessions_lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=update_concurrency)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def oauth_api_call(self, url, headers=None):
         if debug:
             print("[DEBUG] oauth_api_call({})".format(url))
-        try:
-            headers = {"Authorization": "Bearer " + self.token['access_token']}
-            res = requests.get(url, headers=headers)
-            if (res.status_code == 401):
-                self.token = self.oauth_login(self.oauth_client)
-                headers = {"Authorization": "Bearer " + self.token['access_token']}
-                res = requests.get(url, headers=headers)
-            return res
-        except:
-            print("[WARN] > ConnectionError. Retrying...")
-            print("[WARN] > {}".format(url))
-            res = requests.get(url, headers=headers)
-            return res
+        extra_headers = headers or {}
+        session = self.get_session(url)
+        endpoint = api_endpoint(url)
+        for attempt in range(api_max_retries + 1):
+            self.limiter.acquire()
+            try:
+                access_token = self.get_access_token()
+                headers = {"Authorization": "Bearer " + access_token}
+                headers.update(extra_headers)
+                with metrics.timer('pvpdb_api_latency_seconds', endpoint=endpoint):
+                    res = session.get(url, headers=headers)
+                metrics.inc('pvpdb_api_responses_total', endpoint=endpoint, code=res.status_code)
+            except requests.exceptions.RequestException:
+                metrics.inc('pvpdb_api_responses_total', endpoint=endpoint, code='error')
+                if attempt == api_max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                print("[WARN] > ConnectionError. Retrying in {:.1f}s...".format(delay))
+                print("[WARN] > {}".format(url))
+                time.sleep(delay)
+                continue
+            if res.status_code == 401 and attempt == 0:
+                self.get_access_token(expired=access_token)
+            elif res.status_code in [429, 503] and attempt < api_max_retries:
+                delay = backoff_delay(attempt, res)
+                if debug:
+                    print("[DEBUG] [{code}] Throttled, backing off {delay:.1f}s".format(code=res.status_code, delay=delay))
+                self.limiter.pause(delay)
+            else:
+                return res
+        return res
 
     def __init__(self, worker):
         # Check token file
@@ -82,10 +384,49 @@ class Oauth:
         self.client_id = tokens.tokens[worker]['client_id']
         self.client_secret = tokens.tokens[worker]['client_secret']
         self.oauth_client = BackendApplicationClient(client_id=self.client_id)
-        self.token = self.oauth_login(self.oauth_client)
+        self.token_lock = threading.Lock()
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.limiter = RateLimiter(api_rate_per_second, api_rate_per_hour)
+        self.get_access_token()
 
 class Mongo:
     db = None
+    indexed = None
+
+    def create_missing_indexes(self, collection, indexes):
+        # Only once per collection and process, and only the missing indexes are created
+        if collection.name in self.indexed:
+            return
+        existing = [list(index['key']) for index in collection.index_information().values()]
+        missing = [index for index in indexes if list(index.document['key'].items()) not in existing]
+        if len(missing) > 0:
+            collection.create_indexes(missing)
+        self.indexed.add(collection.name)
+
+    def ensure_indexes(self, db_characters):
+        self.create_missing_indexes(db_characters, [
+            pymongo.IndexModel([('lastModified', pymongo.ASCENDING)]),
+            pymongo.IndexModel([('name', pymongo.ASCENDING)]),
+            pymongo.IndexModel([('realm', pymongo.ASCENDING)]),
+            pymongo.IndexModel([('name', pymongo.ASCENDING), ('realm', pymongo.ASCENDING)], unique=True),
+            pymongo.IndexModel([('nextRefresh', pymongo.ASCENDING), ('lastModified', pymongo.ASCENDING)]),
+            pymongo.IndexModel([('lastChanged', pymongo.ASCENDING)])
+        ])
+
+    def ensure_lookup_indexes(self, db_lookups):
+        # Oldest pending request first, finished and abandoned requests expire on their own
+        self.create_missing_indexes(db_lookups, [
+            pymongo.IndexModel([('status', pymongo.ASCENDING), ('requested', pymongo.ASCENDING)]),
+            pymongo.IndexModel([('expires', pymongo.ASCENDING)], expireAfterSeconds=0)
+        ])
+
+    def ensure_history_indexes(self, db_history):
+        # Timeline of a character, and season leaderboards per bracket
+        self.create_missing_indexes(db_history, [
+            pymongo.IndexModel([('c', pymongo.ASCENDING), ('s', pymongo.ASCENDING), ('t', pymongo.ASCENDING)]),
+            pymongo.IndexModel([('s', pymongo.ASCENDING), ('b', pymongo.ASCENDING), ('r', pymongo.DESCENDING)])
+        ])
 
     def __init__(self):
         # Check token file
@@ -104,179 +445,630 @@ class Mongo:
             print("[ERROR] To redeem IDs, check https://develop.battle.net/access/")
             sys.exit(1)
         self.db = pymongo.MongoClient(tokens.mongo_url)
+        self.indexed = set()
+
+def lookup_id(region, faction, realm, name):
+    return '{region}:{faction}:{realm}:{name}'.format(region=region, faction=faction, realm=realm, name=name.lower())
+
+def request_lookup(mongo, region, faction, realm, name):
+    # Queue a priority lookup, unless the same character is already queued or was fetched recently
+    db_lookups = mongo.db['pvpdb']['lookups']
+    mongo.ensure_lookup_indexes(db_lookups)
+    _id = lookup_id(region, faction, realm, name)
+    now = datetime.datetime.utcnow()
+    lookup = db_lookups.find_one({'_id': _id})
+    if lookup is not None and (lookup['status'] in ['pending', 'running'] or lookup.get('done', now) >= now - datetime.timedelta(seconds=lookup_cache_seconds)):
+        return lookup
+    db_lookups.update_one({'_id': _id}, {
+        '$set': {'region': region, 'faction': faction, 'realm': realm, 'name': name.capitalize(), 'status': 'pending', 'requested': now, 'expires': now + datetime.timedelta(seconds=lookup_pending_seconds)},
+        '$unset': {'result': "", 'done': "", 'leaseOwner': "", 'leaseUntil': ""}
+    }, upsert=True)
+    return db_lookups.find_one({'_id': _id})
+
+def wait_lookup(mongo, lookup, timeout=lookup_timeout_seconds):
+    db_lookups = mongo.db['pvpdb']['lookups']
+    deadline = time.monotonic() + timeout
+    while lookup is not None and lookup['status'] in ['pending', 'running'] and time.monotonic() < deadline:
+        time.sleep(lookup_poll_seconds)
+        lookup = db_lookups.find_one({'_id': lookup['_id']})
+    return lookup
 
 class Worker:
     mongo = None
     oauth = None
     realm_slug = None
-    progress = {"current": 0, "total": 0, "timer": 0}
+    progress = None
+    interactive = False
+    lookup_workers = None
+    deleted_realms = None
+    lookups_polled = 0
+    worker_name = None
+    worker_id = None
     region = None
     faction = None
     current_season = None
 
     def logger(self, msg, newline=True, showTimer=False):
-        print(" "*os.get_terminal_size()[0], end='\r')
+        # Progress lines (newline=False) are rate limited, and only rewrite the line on a terminal
+        if not newline:
+            now = time.monotonic()
+            if now - self.progress['logged'] < log_interval:
+                return
+            self.progress['logged'] = now
         if showTimer:
-            print("[{current}/{total}]".format(current=self.progress['current'], total=self.progress['total']), end='')
-        print(msg, end='\n' if newline else '\r')
-
-    def generate_realm_slug(self, file):
-        with open(file, "r") as f:
-            data = f.read()
-            data = data.replace("local _, ns = ...", "")
-            data = data.replace("ns.realmSlugs = ", "")
-            data = data.replace("[", "")
-            data = data.replace("]", "")
-            data = data.replace(" =", ":")
-            data = data.replace(",\n}", "}")
-        return json.loads(data)
+            msg = "[{current}/{total}]{msg}".format(current=self.progress['current'], total=self.progress['total'], msg=msg)
+        if self.interactive:
+            print("\r\033[K" + msg, end='\n' if newline else '\r', flush=not newline)
+        else:
+            print(msg)
 
     def set_current_season(self):
+        # First API call of a run, init and insert never get there and need no token
+        if self.oauth is None:
+            self.oauth = Oauth(self.worker_name)
         season_namespace = 'dynamic-{region}'.format(region=self.region)
         res_season = self.oauth.oauth_api_call(season_url.format(region=self.region, namespace=season_namespace))
         self.current_season = json.loads(res_season.text)['current_season']['id']
 
-    def get_characters_list(self, file):
-        characters = {}
+    def iter_characters_list(self, file):
+        # One RaiderIO line per realm, read lazily
         with open(file, "r") as f:
             for line in f:
                 if ("F = function()" in line):
                     r = re.split('"', line)[1]
                     c = re.split('{|}', line)[1].replace('"', '').split(",")[1:]
-                    characters.update({r: c})
-        return characters
+                    yield r, c
+
+    def iter_chunks(self, characters, size):
+        d = datetime.datetime(1970,1,1)
+        chunk = []
+        for realm, names in characters:
+            if realm not in self.realm_slug:
+                self.logger("[WARN] Realm not found for {region}-{faction}-{realm}, skipping".format(region=self.region, faction=self.faction, realm=realm))
+                continue
+            for c in names:
+                chunk.append({ "name": c, "realm": realm, "lastModified": d, "nextRefresh": d })
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+        if len(chunk) > 0:
+            yield chunk
 
     def init_characters(self):
-        characters = self.get_characters_list("rio/db_{region}_{faction}_characters.lua".format(region=self.region, faction=self.faction))
+        characters = self.iter_characters_list("rio/db_{region}_{faction}_characters.lua".format(region=self.region, faction=self.faction))
         db_characters = self.mongo.db['pvpdb']['characters_{r}_{f}'.format(r=self.region, f=self.faction)]
-        db_characters.create_index([('lastModified', pymongo.ASCENDING)])
-        db_characters.create_index([('name', pymongo.ASCENDING)])
-        db_characters.create_index([('realm', pymongo.ASCENDING)])
-        db_characters.create_index([('name', pymongo.ASCENDING), ('realm', pymongo.ASCENDING)], unique=True)
-        for realm in characters:
-            self.logger("[INFO] Init {region}-{faction}-{realm}".format(region=self.region, faction=self.faction, realm=realm))
-            d = datetime.datetime(1970,1,1)
-            doc = [ { "name": c, "realm": realm, "lastModified": d } for c in characters[realm] if db_characters.find_one({"name": c, "realm": realm}) is None and realm in self.realm_slug ]
-            if len(doc) == 0:
-                print("[INFO] 0 documents to insert, skipping")
-            else:
-                res = db_characters.insert_many(doc)
-                if res.acknowledged:
-                    print("[INFO] Inserted {} documents".format(len(doc)))
-                else:
-                    print("[ERROR] Could not insert {} documents".format(len(doc)))
+        self.mongo.ensure_indexes(db_characters)
+        inserted, total = 0, 0
+        for doc in self.iter_chunks(characters, init_chunk_size):
+            # Existing characters are rejected by the unique name/realm index
+            try:
+                res = db_characters.insert_many(doc, ordered=False)
+                inserted += len(res.inserted_ids)
+            except pymongo.errors.BulkWriteError as e:
+                errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+                if len(errors) > 0:
+                    print("[ERROR] Could not insert {n} documents: {msg}".format(n=len(errors), msg=errors[0]['errmsg']))
+                inserted += e.details['nInserted']
+            total += len(doc)
+        print("[INFO] Init {region}-{faction}: inserted {inserted} of {total} documents".format(region=self.region, faction=self.faction, inserted=inserted, total=total))
 
-    def get_pvp_summary(self, doc):
+    def get_pvp_summary_url(self, doc):
         namespace = "profile-{region}".format(region=self.region)
         if debug:
             self.logger("[DEBUG] get_pvp_summary({doc}, {namespace})".format(doc=doc, namespace=namespace))
-        res = self.oauth.oauth_api_call(pvp_summary_url.format(region=self.region, realm=self.realm_slug[doc['realm']], character=doc['name'].lower(), namespace=namespace))
-        if res.status_code == 200:
+        return pvp_summary_url.format(region=self.region, realm=self.realm_slug[doc['realm']], character=doc['name'].lower(), namespace=namespace)
+
+    def cache_key(self, url):
+        # pvp-summary, 2v2, 3v3, rbg, ...
+        return urllib.parse.urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+    def conditional_headers(self, doc, url):
+        validators = doc.get('http_cache', {}).get(self.cache_key(url), {})
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def store_validators(self, doc, url, res):
+        validators = {}
+        if 'ETag' in res.headers:
+            validators['etag'] = res.headers['ETag']
+        if 'Last-Modified' in res.headers:
+            validators['last_modified'] = res.headers['Last-Modified']
+        if len(validators) > 0:
+            doc.setdefault('http_cache', {})
+            doc['http_cache'][self.cache_key(url)] = validators
+
+    def parse_pvp_summary(self, doc, url, res):
+        # Returns (updated, bracket urls to fetch)
+        if res.status_code == 304:
+            # Nothing changed since the stored data, no bracket to fetch
+            return True, []
+        elif res.status_code == 200:
+            self.store_validators(doc, url, res)
             try:
                 stats_json = json.loads(res.text)
             except json.decoder.JSONDecodeError as e:
                 self.logger("[ERROR] {e}".format(e=e.msg))
                 self.logger("[DEBUG] {text}".format(text=res.text))
-                return None
+                return None, []
             if 'honor_level' in stats_json:
                 doc.update({
                     'honor_level': stats_json['honor_level']
                 })
-            if 'brackets' in stats_json:
-                for bracket in stats_json['brackets']:
-                    res = self.oauth.oauth_api_call(bracket['href'].replace('http://', 'https://'))
-                    if res.status_code == 200:
-                        stats_bracket = json.loads(res.text)
-                        if 'bracket' in stats_bracket:
-                            doc.setdefault('pvp-bracket', {})
-                            doc['pvp-bracket'].setdefault(stats_bracket['bracket']['type'], {})
-                            doc['pvp-bracket'][stats_bracket['bracket']['type']].setdefault('current_statistics', {})
-                            doc['pvp-bracket'][stats_bracket['bracket']['type']].setdefault('s{current_season}_statistics'.format(current_season=self.current_season), {})
-                            statistics = {
-                                'rating': stats_bracket['rating'],
-                                'played': stats_bracket['season_match_statistics']['played'],
-                                'won': stats_bracket['season_match_statistics']['won'],
-                                'lost': stats_bracket['season_match_statistics']['lost']
-                            }
-                            doc['pvp-bracket'][stats_bracket['bracket']['type']]['current_statistics'].update(statistics)
-                            doc['pvp-bracket'][stats_bracket['bracket']['type']]['s{current_season}_statistics'.format(current_season=self.current_season)].update(statistics)
-                    elif res.status_code in [403, 404]:
-                        self.logger("[WARN] Bracket {region}-{realm}-{name} not found".format(region=self.region, realm=doc['realm'], name=doc['name']), False)
-                        return False
-                    else:
-                        self.logger("[ERROR] [{code}] Unexpected bracket error for {region}-{realm}-{name}".format(code=res.status_code, region=self.region, realm=doc['realm'], name=doc['name']))
-                        if res.status_code == 503:
-                            self.logger("[ERROR] Sleep 600 seconds...")
-                            time.sleep(600)
-                        return None
-
+            brackets = [bracket['href'] for bracket in stats_json.get('brackets', [])]
+            if force_https:
+                brackets = [href.replace('http://', 'https://') for href in brackets]
+            return True, brackets
         elif res.status_code in [403, 404]:
             self.logger("[WARN] Characters {region}-{realm}-{name} not found".format(region=self.region, realm=doc['realm'], name=doc['name']), False)
-            return False
+            return False, []
         else:
             self.logger("[ERROR] [{code}] Unexpected summary error for {region}-{realm}-{name}".format(code=res.status_code, region=self.region, realm=doc['realm'], name=doc['name']))
+            return None, []
+
+    def parse_pvp_bracket(self, doc, url, res):
+        if res.status_code == 304:
+            return True
+        elif res.status_code == 200:
+            self.store_validators(doc, url, res)
+            try:
+                stats_bracket = json.loads(res.text)
+            except json.decoder.JSONDecodeError as e:
+                self.logger("[ERROR] {e}".format(e=e.msg))
+                self.logger("[DEBUG] {text}".format(text=res.text))
+                return None
+            if 'bracket' in stats_bracket:
+                doc.setdefault('pvp-bracket', {})
+                doc['pvp-bracket'].setdefault(stats_bracket['bracket']['type'], {})
+                doc['pvp-bracket'][stats_bracket['bracket']['type']].setdefault('current_statistics', {})
+                statistics = {
+                    'rating': stats_bracket['rating'],
+                    'played': stats_bracket['season_match_statistics']['played'],
+                    'won': stats_bracket['season_match_statistics']['won'],
+                    'lost': stats_bracket['season_match_statistics']['lost']
+                }
+                doc['pvp-bracket'][stats_bracket['bracket']['type']]['current_statistics'].update(statistics)
+                if season_history == 'document':
+                    doc['pvp-bracket'][stats_bracket['bracket']['type']].setdefault(self.season_key(), {})
+                    doc['pvp-bracket'][stats_bracket['bracket']['type']][self.season_key()].update(statistics)
+            return True
+        elif res.status_code in [403, 404]:
+            self.logger("[WARN] Bracket {region}-{realm}-{name} not found".format(region=self.region, realm=doc['realm'], name=doc['name']), False)
+            return False
+        else:
+            self.logger("[ERROR] [{code}] Unexpected bracket error for {region}-{realm}-{name}".format(code=res.status_code, region=self.region, realm=doc['realm'], name=doc['name']))
+            return None
+
+    def get_pvp_summary(self, doc):
+        url = self.get_pvp_summary_url(doc)
+        res = self.oauth.oauth_api_call(url, self.conditional_headers(doc, url))
+        updated, brackets = self.parse_pvp_summary(doc, url, res)
+        for href in brackets:
+            res = self.oauth.oauth_api_call(href, self.conditional_headers(doc, href))
+            updated = self.parse_pvp_bracket(doc, href, res)
+            if updated is not True:
+                return updated
+        return updated
+
+    async def get_pvp_summary_async(self, doc, executor):
+        loop = asyncio.get_running_loop()
+        url = self.get_pvp_summary_url(doc)
+        res = await loop.run_in_executor(executor, self.oauth.oauth_api_call, url, self.conditional_headers(doc, url))
+        updated, brackets = self.parse_pvp_summary(doc, url, res)
+        # All brackets of a character are fetched at once
+        responses = await asyncio.gather(*[loop.run_in_executor(executor, self.oauth.oauth_api_call, href, self.conditional_headers(doc, href)) for href in brackets])
+        for href, res in zip(brackets, responses):
+            updated = self.parse_pvp_bracket(doc, href, res)
+            if updated is not True:
+                return updated
+        return updated
+
+    def fetch_character(self, doc):
+        # An error on one character resets it, the rest of its batch is still written
+        try:
+            return self.get_pvp_summary(doc)
+        except Exception as e:
+            self.logger("[ERROR] Fetch failed for {region}-{realm}-{name}: {e!r}".format(region=self.region, realm=doc['realm'], name=doc['name'], e=e))
             return None
-        return True
+
+    async def fetch_character_async(self, doc, executor):
+        try:
+            return await self.get_pvp_summary_async(doc, executor)
+        except Exception as e:
+            self.logger("[ERROR] Fetch failed for {region}-{realm}-{name}: {e!r}".format(region=self.region, realm=doc['realm'], name=doc['name'], e=e))
+            return None
+
+    def season_key(self):
+        return 's{current_season}_statistics'.format(current_season=self.current_season)
+
+    def history_entries(self, doc, previous):
+        # One compact entry per bracket whose statistics moved since the previous fetch
+        if season_history != 'collection':
+            return []
+        entries = []
+        now = datetime.datetime.utcnow()
+        current = self.bracket_statistics(doc)
+        for bracket in self.changed_brackets(doc, previous):
+            stats = current[bracket]
+            if stats.get('played', 0) > 0 and 'rating' in stats:
+                entries.append({'c': doc['_id'], 's': self.current_season, 'b': history_brackets.get(bracket, bracket), 't': now, 'r': stats['rating'], 'w': stats['won'], 'l': stats['lost']})
+        return entries
+
+    def history_collection(self):
+        return self.mongo.db['pvpdb']['history_{r}_{f}'.format(r=self.region, f=self.faction)]
+
+    def deleted_collection(self):
+        # Latest deletion per realm, written with the server clock like lastChanged
+        return self.mongo.db['pvpdb']['deleted_{r}_{f}'.format(r=self.region, f=self.faction)]
+
+    def bracket_statistics(self, doc):
+        return {bracket: dict(stats.get('current_statistics', {})) for bracket, stats in doc.get('pvp-bracket', {}).items()}
+
+    def stored_state(self, doc):
+        # The fields a fetch may overwrite, as stored before it
+        return {
+            'honor_level': doc.get('honor_level'),
+            'http_cache': {key: dict(validators) for key, validators in doc.get('http_cache', {}).items()},
+            'pvp-bracket': self.bracket_statistics(doc)
+        }
+
+    def changed_brackets(self, doc, previous):
+        return [bracket for bracket, stats in self.bracket_statistics(doc).items() if stats != previous['pvp-bracket'].get(bracket)]
+
+    def schedule_refresh(self, doc, previous):
+        # Hours until the next refresh, from how the statistics moved since the previous fetch
+        # Only games played since a previous fetch count, a bracket seen for the first time gets the dormant interval
+        current = self.bracket_statistics(doc)
+        played = {bracket: stats.get('played', 0) for bracket, stats in previous['pvp-bracket'].items()}
+        active = any(bracket in played and current[bracket].get('played', 0) > played[bracket] for bracket in self.changed_brackets(doc, previous))
+        high_rated = max([stats.get('rating', 0) for stats in current.values()] + [0]) >= refresh_high_rating
+        if active:
+            hours = refresh_min_hours if high_rated else refresh_active_hours
+        else:
+            hours = min(refresh_max_hours, max(character_days_ttl * 24, doc.get('refreshHours', 0) * 2))
+            if high_rated:
+                hours = min(hours, character_days_ttl * 24)
+        # Spread refreshes so that batches do not come back all at once
+        next_refresh = datetime.datetime.now() + datetime.timedelta(hours=hours * random.uniform(0.9, 1.1))
+        return hours, next_refresh
+
+    def claim_characters(self, db_characters, limit=claim_batch_size):
+        # Lease a batch of stale characters to this worker, other workers skip them until the lease expires
+        while True:
+            now = datetime.datetime.now()
+            now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+            lease = now + datetime.timedelta(minutes=claim_lease_minutes)
+            with metrics.timer('pvpdb_mongo_latency_seconds', op='claim'):
+                ids = [c['_id'] for c in db_characters.find(stale_filter(now), {"_id": 1}).sort('nextRefresh', pymongo.ASCENDING).limit(limit)]
+                if len(ids) == 0:
+                    return []
+                query = stale_filter(now)
+                query.update({"_id": { "$in": ids }})
+                db_characters.update_many(query, {"$set": {"leaseOwner": self.worker_id, "leaseUntil": lease}})
+                docs = list(db_characters.find({"_id": { "$in": ids }, "leaseOwner": self.worker_id, "leaseUntil": lease}))
+            if len(docs) > 0:
+                return docs
+
+    def release_character(self, doc):
+        return pymongo.UpdateOne({"_id": doc['_id'], "leaseOwner": self.worker_id}, {"$unset": {"leaseOwner": "", "leaseUntil": ""}})
+
+    def count_character(self, result):
+        self.progress['current'] = max(0, self.progress['current'] - 1)
+        self.progress['done'] += 1
+        metrics.inc('pvpdb_characters_total', region=self.region, faction=self.faction, result=result)
+        metrics.set('pvpdb_backlog', self.progress['current'], region=self.region, faction=self.faction)
+        metrics.set('pvpdb_characters_per_second', round(self.progress['done'] / max(1, time.monotonic() - self.progress['started']), 2), region=self.region, faction=self.faction)
+
+    def character_write(self, doc, updated, previous):
+        # Build the Mongo operation storing the result of get_pvp_summary, a no-op once the lease went to another worker
+        changed = self.changed_brackets(doc, previous) if updated == True else []
+        self.count_character({None: 'reset', True: 'updated' if len(changed) > 0 else 'unchanged', False: 'deleted'}[updated])
+        if updated == None:
+            self.logger("[WARN] Reset lastModified for {region}-{realm}-{name}".format(region=self.region, realm=doc['realm'], name=doc['name']), newline=False, showTimer=True)
+            retry_hours = min(refresh_max_hours, max(refresh_retry_hours, doc.get('retryHours', 0) * 2))
+            return pymongo.UpdateOne(
+                {"_id": doc['_id'], "leaseOwner": self.worker_id},
+                {
+                    "$set": {"lastModified": None, "retryHours": retry_hours, "nextRefresh": datetime.datetime.now() + datetime.timedelta(hours=retry_hours)},
+                    "$unset": {"leaseOwner": "", "leaseUntil": ""}
+                }
+            )
+        elif updated == True:
+            self.logger("[INFO] {state} {region}-{realm}-{name}".format(state='Updated' if len(changed) > 0 else 'Unchanged', region=self.region, realm=doc['realm'], name=doc['name']), newline=False, showTimer=True)
+            # Only the paths that differ from the stored document, unchanged characters only get their schedule and lastModified
+            fields = {}
+            fields['refreshHours'], fields['nextRefresh'] = self.schedule_refresh(doc, previous)
+            if doc.get('honor_level') != previous['honor_level']:
+                fields['honor_level'] = doc['honor_level']
+            for key, validators in doc.get('http_cache', {}).items():
+                if validators != previous['http_cache'].get(key):
+                    fields['http_cache.{key}'.format(key=key)] = validators
+            # s{season}_statistics is only maintained by parse_pvp_bracket in the legacy 'document' mode
+            keys = ['current_statistics', self.season_key()] if season_history == 'document' else ['current_statistics']
+            for bracket in changed:
+                for key in keys:
+                    if key in doc['pvp-bracket'][bracket]:
+                        fields['pvp-bracket.{bracket}.{key}'.format(bracket=bracket, key=key)] = doc['pvp-bracket'][bracket][key]
+            # lastModified is when the character was last fetched, lastChanged when its statistics last moved
+            dates = {"lastModified": True}
+            if len(changed) > 0:
+                dates["lastChanged"] = True
+            elif 'lastChanged' not in doc:
+                # Documents written before lastChanged existed: the previous write is the latest possible change
+                fields['lastChanged'] = doc.get('lastModified') or datetime.datetime(1970,1,1)
+            return pymongo.UpdateOne(
+                {"_id": doc['_id'], "leaseOwner": self.worker_id},
+                {
+                    "$set": fields,
+                    "$unset": {"leaseOwner": "", "leaseUntil": "", "retryHours": ""},
+                    "$currentDate": dates
+                }
+            )
+        else:
+            self.logger("[WARN] Deleting {region}-{realm}-{name}".format(region=self.region, realm=doc['realm'], name=doc['name']), newline=False, showTimer=True)
+            return self.delete_character(doc)
+
+    def delete_character(self, doc):
+        # The incremental export finds the realms that lost characters in deleted_{region}_{faction}
+        self.deleted_realms.add(doc['realm'])
+        return pymongo.DeleteOne({"_id": doc['_id'], "leaseOwner": self.worker_id})
+
+    def flush_writes(self, db_characters, ops, history=None):
+        if len(ops) == 0:
+            return
+        try:
+            with metrics.timer('pvpdb_mongo_latency_seconds', op='bulk_write'):
+                db_characters.bulk_write(ops, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            self.logger("[ERROR] Mongo error for {n} of {total} updates in {region} {faction}".format(n=len(e.details['writeErrors']), total=len(ops), region=self.region, faction=self.faction))
+        if history:
+            with metrics.timer('pvpdb_mongo_latency_seconds', op='history'):
+                self.history_collection().insert_many(history, ordered=False)
+        # Swapped rather than cleared, async crawl tasks keep adding realms while a flush runs
+        deleted, self.deleted_realms = self.deleted_realms, set()
+        if len(deleted) > 0:
+            with metrics.timer('pvpdb_mongo_latency_seconds', op='deleted'):
+                self.deleted_collection().bulk_write([pymongo.UpdateOne({"_id": realm}, {"$currentDate": {"deleted": True}}, upsert=True) for realm in deleted], ordered=False)
+
+    def lookup_collection(self):
+        return self.mongo.db['pvpdb']['lookups']
+
+    def claim_lookup(self):
+        # Pending requests of any region/faction, or running ones whose worker died
+        now = datetime.datetime.utcnow()
+        with metrics.timer('pvpdb_mongo_latency_seconds', op='lookup'):
+            return self.lookup_collection().find_one_and_update(
+                {"status": {"$in": ["pending", "running"]}, "$or": [{"leaseUntil": None}, {"leaseUntil": {"$lte": now}}]},
+                {"$set": {"status": "running", "leaseOwner": self.worker_id, "leaseUntil": now + datetime.timedelta(seconds=lookup_lease_seconds)}},
+                sort=[("requested", pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+
+    def lookup_worker(self, region, faction):
+        # Lookups of another collection are served with the Mongo client, token and realms of this worker
+        if (region, faction) == (self.region, self.faction):
+            return self
+        if (region, faction) not in self.lookup_workers:
+            worker = Worker(self.worker_name, region, faction, self.mongo, self.oauth, self.realm_slug)
+            worker.set_current_season()
+            worker.mongo.ensure_history_indexes(worker.history_collection())
+            self.lookup_workers[(region, faction)] = worker
+        return self.lookup_workers[(region, faction)]
+
+    def lookup_character(self, lookup):
+        db_characters = self.mongo.db['pvpdb']['characters_{r}_{f}'.format(r=self.region, f=self.faction)]
+        status, result = 'error', None
+        if lookup['realm'] not in self.realm_slug:
+            self.logger("[WARN] Realm not found for lookup {id}".format(id=lookup['_id']))
+        else:
+            # Characters missing from RaiderIO are added on the fly
+            d = datetime.datetime(1970,1,1)
+            db_characters.update_one({"name": lookup['name'], "realm": lookup['realm']}, {"$setOnInsert": {"lastModified": d, "nextRefresh": d}}, upsert=True)
+            # Leased like a claimed batch, whether or not it is stale, so that its write cannot clear another worker's lease
+            now = datetime.datetime.now()
+            doc = db_characters.find_one_and_update(
+                {"name": lookup['name'], "realm": lookup['realm'], "$or": [{"leaseUntil": None}, {"leaseUntil": {"$lte": now}}]},
+                {"$set": {"leaseOwner": self.worker_id, "leaseUntil": now + datetime.timedelta(minutes=claim_lease_minutes)}},
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+            if doc is None:
+                self.defer_lookup(lookup)
+                return
+            previous = self.stored_state(doc)
+            updated = self.fetch_character(doc)
+            history = self.history_entries(doc, previous) if updated == True else []
+            self.flush_writes(db_characters, [self.character_write(doc, updated, previous)], history)
+            status = {None: 'error', True: 'done', False: 'not_found'}[updated]
+            if updated == True:
+                result = {'honor_level': doc.get('honor_level'), 'pvp-bracket': self.bracket_statistics(doc)}
+        self.finish_lookup(lookup, status, result)
+
+    def finish_lookup(self, lookup, status, result=None):
+        now = datetime.datetime.utcnow()
+        metrics.inc('pvpdb_lookups_total', region=lookup['region'], faction=lookup['faction'], status=status)
+        self.lookup_collection().update_one({"_id": lookup['_id'], "leaseOwner": self.worker_id}, {
+            "$set": {"status": status, "result": result, "done": now, "expires": now + datetime.timedelta(seconds=lookup_cache_seconds)},
+            "$unset": {"leaseOwner": "", "leaseUntil": ""}
+        })
+
+    def defer_lookup(self, lookup):
+        # Back to pending, other workers skip it until leaseUntil
+        self.lookup_collection().update_one({"_id": lookup['_id'], "leaseOwner": self.worker_id}, {
+            "$set": {"status": "pending", "leaseUntil": datetime.datetime.utcnow() + datetime.timedelta(seconds=lookup_retry_seconds)},
+            "$unset": {"leaseOwner": ""}
+        })
+
+    def process_lookups(self):
+        # Requested characters go before the next bulk batch
+        for i in range(lookup_batch_size):
+            lookup = self.claim_lookup()
+            if lookup is None:
+                return
+            try:
+                worker = self.lookup_worker(lookup['region'], lookup['faction'])
+            except Exception as e:
+                self.logger("[ERROR] Cannot serve lookup {id}: {e!r}".format(id=lookup['_id'], e=e))
+                self.finish_lookup(lookup, 'error')
+                continue
+            worker.lookup_character(lookup)
+
+    def poll_lookups(self):
+        # Between two characters of a sync batch: one indexed read per lookup_poll_seconds while nothing is queued
+        now = time.monotonic()
+        if now - self.lookups_polled < lookup_poll_seconds:
+            return
+        self.lookups_polled = now
+        with metrics.timer('pvpdb_mongo_latency_seconds', op='lookup'):
+            pending = self.lookup_collection().find_one({"status": "pending"}, {"_id": 1})
+        if pending is not None:
+            self.process_lookups()
+
+    async def serve_lookups(self, executor):
+        # Async runs serve lookups from their own task, the crawl tasks may hold a full batch for a while
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(executor, self.process_lookups)
+            await asyncio.sleep(lookup_poll_seconds)
+
+    def init_progress(self, db_characters):
+        with metrics.timer('pvpdb_mongo_latency_seconds', op='count'):
+            self.progress["total"] = db_characters.estimated_document_count()
+            self.progress["current"] = db_characters.count_documents(stale_filter(datetime.datetime.now()))
+        self.progress["done"] = 0
+        self.progress["started"] = time.monotonic()
+        metrics.set('pvpdb_backlog', self.progress['current'], region=self.region, faction=self.faction)
 
     def update_characters(self):
         db_characters = self.mongo.db['pvpdb']['characters_{r}_{f}'.format(r=self.region, f=self.faction)]
-        self.progress["total"] = db_characters.count({})
-        self.progress['timer'] = 0
+        self.mongo.ensure_indexes(db_characters)
+        self.mongo.ensure_history_indexes(self.history_collection())
+        self.mongo.ensure_lookup_indexes(self.lookup_collection())
+        self.set_current_season()
+        self.init_progress(db_characters)
         killer = GracefulKiller()
         while not killer.kill_now:
-            self.progress['timer'] -= 1
-            if self.progress['timer'] <= 0:
-                self.progress['timer'] = 10
-                d = datetime.datetime.now() + datetime.timedelta(days=-character_days_ttl)
-                self.progress["current"] = db_characters.count({"lastModified": { "$lte": d }})
-            doc = db_characters.find_one_and_update(
-                {"lastModified": { "$lte": d }},
-                {"$currentDate": {"lastModified": True}}
-            )
-            if doc == None:
+            self.process_lookups()
+            docs = self.claim_characters(db_characters)
+            if len(docs) == 0:
                 self.logger("[INFO] No update found for {region} {faction}".format(region=self.region, faction=self.faction), newline=True, showTimer=True)
                 break
-            if doc['realm'] not in self.realm_slug:
+            ops, history, done = [], [], 0
+            try:
+                for doc in docs:
+                    if not killer.kill_now:
+                        self.poll_lookups()
+                    if killer.kill_now:
+                        ops.append(self.release_character(doc))
+                    elif doc['realm'] not in self.realm_slug:
+                        self.logger("[WARN] Realm not found for {region}-{faction}-{realm}-{name}".format(region=self.region, faction=self.faction, realm=doc['realm'], name=doc['name']))
+                        self.count_character('deleted')
+                        ops.append(self.delete_character(doc))
+                    else:
+                        previous = self.stored_state(doc)
+                        updated = self.fetch_character(doc)
+                        if updated == True:
+                            history.extend(self.history_entries(doc, previous))
+                        ops.append(self.character_write(doc, updated, previous))
+                    done += 1
+            finally:
+                # Results already fetched are written, and the rest of the batch released, whatever stopped the loop
+                ops.extend(self.release_character(doc) for doc in docs[done:])
+                self.flush_writes(db_characters, ops, history)
+
+        if killer.kill_now:
+            self.logger("[INFO] Graceful shutdown")
+            sys.exit(0)
+
+    async def claim(self, db_characters, killer, executor, queue, concurrency, ops):
+        # Feed the crawl tasks with leased batches until the backlog is empty
+        loop = asyncio.get_running_loop()
+        while not killer.kill_now:
+            docs = await loop.run_in_executor(executor, self.claim_characters, db_characters)
+            if len(docs) == 0:
+                break
+            queued = 0
+            try:
+                for doc in docs:
+                    await queue.put(doc)
+                    queued += 1
+            except BaseException:
+                # Cancelled while the queue was full
+                ops.extend(self.release_character(doc) for doc in docs[queued:])
+                raise
+        for i in range(concurrency):
+            await queue.put(None)
+
+    async def crawl(self, db_characters, killer, executor, queue, ops, history):
+        # One crawl task: fetch characters from the queue and buffer their writes
+        loop = asyncio.get_running_loop()
+        while True:
+            doc = await queue.get()
+            if doc == None:
+                return
+            if killer.kill_now:
+                ops.append(self.release_character(doc))
+            elif doc['realm'] not in self.realm_slug:
                 self.logger("[WARN] Realm not found for {region}-{faction}-{realm}-{name}".format(region=self.region, faction=self.faction, realm=doc['realm'], name=doc['name']))
-                db_characters.remove({"_id": doc['_id']})
-                continue
-            updated = self.get_pvp_summary(doc)
-            if updated == None:
-                res = db_characters.update_one(
-                    {"_id": doc['_id']},
-                    {
-                        "$set": {"lastModified": None}
-                    }
-                )
-                if res.acknowledged:
-                    self.logger("[WARN] Reset lastModified for {region}-{realm}-{name}".format(region=self.region, realm=doc['realm'], name=doc['name']), newline=False, showTimer=True)
-                else:
-                    self.logger("[ERROR] Mongo error for update {region}-{realm}-{name}".format(region=self.region, realm=doc['realm'], name=doc['name']))
-            elif updated == True:
-                del doc['lastModified']
-                res = db_characters.update_one(
-                    {"_id": doc['_id']},
-                    {
-                        "$set": doc,
-                        "$currentDate": {"lastModified": True}
-                    }
-                )
-                if res.acknowledged:
-                    self.logger("[INFO] Updated {region}-{realm}-{name}".format(region=self.region, realm=doc['realm'], name=doc['name']), newline=False, showTimer=True)
-                else:
-                    self.logger("[ERROR] Mongo error for update {region}-{realm}-{name}".format(region=self.region, realm=doc['realm'], name=doc['name']))
+                self.count_character('deleted')
+                ops.append(self.delete_character(doc))
             else:
-                self.logger("[WARN] Deleting {region}-{realm}-{name}".format(region=self.region, realm=doc['realm'], name=doc['name']), newline=False, showTimer=True)
-                db_characters.remove({"_id": doc['_id']})
+                try:
+                    previous = self.stored_state(doc)
+                    updated = await self.fetch_character_async(doc, executor)
+                    if updated == True:
+                        history.extend(self.history_entries(doc, previous))
+                    ops.append(self.character_write(doc, updated, previous))
+                except BaseException:
+                    # Cancelled, or a bug in the write: the lease is released rather than left to expire
+                    ops.append(self.release_character(doc))
+                    raise
+            if len(ops) >= claim_batch_size:
+                batch, history_batch = ops[:], history[:]
+                ops.clear()
+                history.clear()
+                await loop.run_in_executor(executor, self.flush_writes, db_characters, batch, history_batch)
+
+    async def crawl_all(self, db_characters, killer, concurrency):
+        queue = asyncio.Queue(maxsize=claim_batch_size)
+        ops, history = [], []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency + 2) as executor:
+            lookups = asyncio.ensure_future(self.serve_lookups(executor))
+            tasks = [asyncio.ensure_future(self.claim(db_characters, killer, executor, queue, concurrency, ops))]
+            tasks += [asyncio.ensure_future(self.crawl(db_characters, killer, executor, queue, ops, history)) for i in range(concurrency)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # A failed task stops the others, buffered results are still written and queued characters released
+                for task in tasks + [lookups]:
+                    task.cancel()
+                await asyncio.gather(*tasks, lookups, return_exceptions=True)
+                while not queue.empty():
+                    doc = queue.get_nowait()
+                    if doc is not None:
+                        ops.append(self.release_character(doc))
+                self.flush_writes(db_characters, ops, history)
 
+    def update_characters_async(self, concurrency=update_concurrency):
+        db_characters = self.mongo.db['pvpdb']['characters_{r}_{f}'.format(r=self.region, f=self.faction)]
+        self.mongo.ensure_indexes(db_characters)
+        self.mongo.ensure_history_indexes(self.history_collection())
+        self.mongo.ensure_lookup_indexes(self.lookup_collection())
+        self.set_current_season()
+        self.init_progress(db_characters)
+        killer = GracefulKiller()
+        asyncio.run(self.crawl_all(db_characters, killer, concurrency))
         if killer.kill_now:
             self.logger("[INFO] Graceful shutdown")
             sys.exit(0)
+        self.logger("[INFO] No update found for {region} {faction}".format(region=self.region, faction=self.faction), newline=True, showTimer=True)
 
     def insert_character(self, realm, name):
         db_characters = self.mongo.db['pvpdb']['characters_{r}_{f}'.format(r=self.region, f=self.faction)]
         d = datetime.datetime(1970,1,1)
-        doc = [ { "name": name, "realm": realm, "lastModified": d } ]
+        doc = [ { "name": name, "realm": realm, "lastModified": d, "nextRefresh": d } ]
         if len(doc) == 0:
             print("[INFO] 0 documents to insert, skipping")
         else:
@@ -287,30 +1079,216 @@ class Worker:
                 print("[ERROR] Could not insert {} documents".format(len(doc)))
 
 
-    def __init__(self, worker, region, faction):
-        # Check usage
-        if len(sys.argv) <= 1:
-            self.logger("[ERROR] Usage: workers-pvpdb.py <tokenid> [action] [region] [faction]")
-            sys.exit(1)
-
-        self.realm_slug = self.generate_realm_slug('rio/db_realms.lua')
-        self.mongo = Mongo()
-        self.oauth = Oauth(worker)
+    def __init__(self, worker, region, faction, mongo=None, oauth=None, realm_slug=None):
+        self.progress = {"current": 0, "total": 0, "done": 0, "started": time.monotonic(), "logged": 0}
+        self.interactive = sys.stdout.isatty()
+        # Mongo client, OAuth token and HTTP sessions can be shared by all the workers of a run
+        self.realm_slug = realm_slug if realm_slug is not None else generate_realm_slug('rio/db_realms.lua')
+        self.mongo = mongo if mongo is not None else Mongo()
+        self.oauth = oauth
+        self.worker_name = worker
+        self.lookup_workers = {}
+        self.deleted_realms = set()
+        self.worker_id = "{worker}@{host}:{pid}".format(worker=worker, host=socket.gethostname(), pid=os.getpid())
         self.region = region
         self.faction = faction
-        self.set_current_season()
 
-def main():
-    if len(sys.argv) >= 2 and sys.argv[1] == "init":
+def init_collection(args):
+    # Runs in its own process, with its own Mongo client
+    worker, region, faction = args
+    Worker(worker, region, faction).init_characters()
+
+def update_collection(worker, region, faction, concurrency, port):
+    # Supervised worker process: the supervisor stops it with SIGTERM
+    global metrics
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Fresh registry, the one inherited from the supervisor holds its own series and lock
+    metrics = Metrics()
+    metrics.start(worker, port)
+    Worker(worker, region, faction).update_characters_async(concurrency)
+
+def migrate_history(mongo, region, faction):
+    # Move the s{season}_statistics subdocuments of a collection to its history collection
+    db_characters = mongo.db['pvpdb']['characters_{r}_{f}'.format(r=region, f=faction)]
+    db_history = mongo.db['pvpdb']['history_{r}_{f}'.format(r=region, f=faction)]
+    mongo.ensure_history_indexes(db_history)
+    season_key = re.compile(r'^s(\d+)_statistics$')
+    migrated, entries, ops = 0, [], []
+    for doc in db_characters.find({'pvp-bracket': {'$exists': True}}, {'pvp-bracket': 1, 'lastModified': 1}).batch_size(migrate_chunk_size):
+        unset = {}
+        for bracket, stats in doc['pvp-bracket'].items():
+            for key, season_stats in stats.items():
+                m = season_key.match(key)
+                if m is None:
+                    continue
+                unset['pvp-bracket.{bracket}.{key}'.format(bracket=bracket, key=key)] = ""
+                if season_stats.get('played', 0) > 0 and 'rating' in season_stats:
+                    entries.append({'c': doc['_id'], 's': int(m.group(1)), 'b': history_brackets.get(bracket, bracket), 't': doc.get('lastModified') or datetime.datetime.utcnow(), 'r': season_stats['rating'], 'w': season_stats.get('won', 0), 'l': season_stats.get('lost', 0)})
+        if len(unset) > 0:
+            ops.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$unset': unset}))
+        if len(ops) >= migrate_chunk_size:
+            # History first: an interrupted migration duplicates entries rather than losing them
+            if len(entries) > 0:
+                db_history.insert_many(entries, ordered=False)
+            db_characters.bulk_write(ops, ordered=False)
+            migrated += len(ops)
+            entries, ops = [], []
+    if len(entries) > 0:
+        db_history.insert_many(entries, ordered=False)
+    if len(ops) > 0:
+        db_characters.bulk_write(ops, ordered=False)
+        migrated += len(ops)
+    print("[INFO] Migrated the season history of {n} characters in {region}-{faction}".format(n=migrated, region=region, faction=faction))
+
+def season_leaderboard(mongo, region, faction, season, bracket, limit=100):
+    # Highest rating reached by each character in a season, read in order from the s/b/r index
+    db_characters = mongo.db['pvpdb']['characters_{r}_{f}'.format(r=region, f=faction)]
+    db_history = mongo.db['pvpdb']['history_{r}_{f}'.format(r=region, f=faction)]
+    best = {}
+    for entry in db_history.find({'s': season, 'b': bracket}, {'_id': 0, 'c': 1, 'r': 1, 'w': 1, 'l': 1}).sort('r', pymongo.DESCENDING):
+        if entry['c'] not in best:
+            best[entry['c']] = entry
+            if len(best) >= limit:
+                break
+    characters = {c['_id']: c for c in db_characters.find({'_id': {'$in': list(best)}}, {'name': 1, 'realm': 1})}
+    return [dict(entry, name=characters[c]['name'], realm=characters[c]['realm']) for c, entry in best.items() if c in characters]
+
+class Supervisor:
+    mongo = None
+    workers = None
+    concurrency = None
+    processes = None
+    assignments = None
+    next_start = None
+    idle = None
+
+    def pending_lookups(self):
+        # Queued priority lookups, per region/faction
+        pending = {}
+        for lookup in self.mongo.db['pvpdb']['lookups'].find({"status": "pending"}, {"region": 1, "faction": 1}):
+            collection = (lookup['region'], lookup['faction'])
+            pending[collection] = pending.get(collection, 0) + 1
+        return pending
+
+    def backlog(self):
+        # Characters due for a refresh per region/faction, a pending lookup weighs as much as lookup_backlog_weight of them
+        now = datetime.datetime.now()
+        pending = self.pending_lookups()
+        backlog = {}
         for r in ["eu", "us", "kr", "tw"]:
             for f in ["alliance", "horde"]:
-                worker = Worker(sys.argv[2], r, f)
-                worker.init_characters()
+                db_characters = self.mongo.db['pvpdb']['characters_{r}_{f}'.format(r=r, f=f)]
+                with metrics.timer('pvpdb_mongo_latency_seconds', op='count'):
+                    backlog[(r, f)] = db_characters.count_documents(stale_filter(now))
+                metrics.set('pvpdb_backlog', backlog[(r, f)], region=r, faction=f)
+                metrics.set('pvpdb_lookups_pending', pending.get((r, f), 0), region=r, faction=f)
+                backlog[(r, f)] += pending.get((r, f), 0) * lookup_backlog_weight
+        return backlog
+
+    def wake_for_lookups(self):
+        # Lookups cannot wait for supervise_idle_seconds: any running worker serves them, otherwise start an idle one on their collection
+        if len(self.idle) == 0 or any(self.processes.get(w) is not None and self.processes[w].is_alive() for w in self.workers):
+            return
+        pending = self.pending_lookups()
+        if len(pending) > 0:
+            worker = self.workers[min(self.workers.index(w) for w in self.idle)]
+            self.start(worker, max(pending, key=pending.get))
+
+    def assign(self):
+        # Biggest backlog per worker already on it
+        backlog = self.backlog()
+        running = [self.assignments[w] for w in self.workers if self.processes.get(w) is not None and self.processes[w].is_alive()]
+        candidates = [(backlog[c] / (running.count(c) + 1), c) for c in backlog if backlog[c] > 0]
+        if len(candidates) == 0:
+            return None
+        return max(candidates)[1]
+
+    def start(self, worker, collection=None):
+        if collection is None:
+            collection = self.assign()
+        if collection is None:
+            print("[INFO] No backlog for {worker}, sleeping {s} seconds".format(worker=worker, s=supervise_idle_seconds))
+            self.next_start[worker] = time.monotonic() + supervise_idle_seconds
+            self.idle.add(worker)
+            return
+        self.idle.discard(worker)
+        region, faction = collection
+        print("[INFO] Starting {worker} on {region} {faction}".format(worker=worker, region=region, faction=faction))
+        port = metrics_port + 1 + self.workers.index(worker)
+        process = multiprocessing.Process(target=update_collection, args=(worker, region, faction, self.concurrency, port), name=worker)
+        process.start()
+        self.processes[worker] = process
+        self.assignments[worker] = collection
+
+    def check(self, worker):
+        process = self.processes.get(worker)
+        if process is not None:
+            if process.is_alive():
+                return
+            region, faction = self.assignments[worker]
+            metrics.inc('pvpdb_worker_exits_total', worker=worker, code=process.exitcode)
+            if process.exitcode != 0:
+                print("[ERROR] {worker} crashed on {region} {faction} with exit code {code}, restarting in {s} seconds".format(worker=worker, region=region, faction=faction, code=process.exitcode, s=supervise_restart_seconds))
+                self.next_start[worker] = time.monotonic() + supervise_restart_seconds
+            self.processes[worker] = None
+        if time.monotonic() >= self.next_start.get(worker, 0):
+            self.start(worker)
+
+    def stop(self):
+        for worker, process in self.processes.items():
+            if process is not None and process.is_alive():
+                process.terminate()
+        for worker, process in self.processes.items():
+            if process is not None:
+                process.join(supervise_stop_seconds)
+                if process.is_alive():
+                    print("[WARN] Killing {worker}".format(worker=worker))
+                    process.kill()
+
+    def run(self):
+        killer = GracefulKiller()
+        metrics.start('supervise', metrics_port)
+        while not killer.kill_now:
+            self.wake_for_lookups()
+            for worker in self.workers:
+                self.check(worker)
+            time.sleep(supervise_poll_seconds)
+        print("[INFO] Graceful shutdown, stopping workers")
+        self.stop()
+
+    def __init__(self, concurrency):
+        self.mongo = Mongo()
+        import tokens
+        self.workers = list(tokens.tokens)
+        self.concurrency = concurrency
+        self.processes = {}
+        self.assignments = {}
+        self.next_start = {}
+        self.idle = set()
+
+def main():
+    global update_concurrency
+    if len(sys.argv) >= 2 and sys.argv[1] == "init":
+        collections = [(sys.argv[2], r, f) for r in ["eu", "us", "kr", "tw"] for f in ["alliance", "horde"]]
+        with multiprocessing.Pool(init_processes) as pool:
+            pool.map(init_collection, collections)
     elif len(sys.argv) >= 2 and sys.argv[1] == "update":
+        mongo, oauth, realm_slug = Mongo(), Oauth(sys.argv[2]), generate_realm_slug('rio/db_realms.lua')
+        metrics.start(sys.argv[2], metrics_port)
         for r in ["eu", "us", "kr", "tw"]:
             for f in ["alliance", "horde"]:
-                worker = Worker(sys.argv[2], r, f)
+                worker = Worker(sys.argv[2], r, f, mongo, oauth, realm_slug)
                 worker.update_characters()
+    elif len(sys.argv) >= 3 and sys.argv[1] == "update-async":
+        if len(sys.argv) >= 4:
+            update_concurrency = int(sys.argv[3])
+        mongo, oauth, realm_slug = Mongo(), Oauth(sys.argv[2]), generate_realm_slug('rio/db_realms.lua')
+        metrics.start(sys.argv[2], metrics_port)
+        for r in ["eu", "us", "kr", "tw"]:
+            for f in ["alliance", "horde"]:
+                worker = Worker(sys.argv[2], r, f, mongo, oauth, realm_slug)
+                worker.update_characters_async(update_concurrency)
     elif len(sys.argv) >= 6 and sys.argv[1] == "insert":
         region = sys.argv[3]
         faction = sys.argv[4]
@@ -318,7 +1296,29 @@ def main():
         name = sys.argv[6]
         worker = Worker(sys.argv[2], region, faction)
         worker.insert_character(realm, name)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "migrate-history":
+        mongo = Mongo()
+        for r in ["eu", "us", "kr", "tw"]:
+            for f in ["alliance", "horde"]:
+                migrate_history(mongo, r, f)
+    elif len(sys.argv) >= 6 and sys.argv[1] == "leaderboard":
+        limit = int(sys.argv[6]) if len(sys.argv) >= 7 else 100
+        for rank, entry in enumerate(season_leaderboard(Mongo(), sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5], limit), 1):
+            print("{rank:>4} {rating:>5} {won:>5}-{lost:<5} {name}-{realm}".format(rank=rank, rating=entry['r'], won=entry['w'], lost=entry['l'], name=entry['name'], realm=entry['realm']))
+    elif len(sys.argv) >= 6 and sys.argv[1] == "lookup":
+        timeout = int(sys.argv[6]) if len(sys.argv) >= 7 else lookup_timeout_seconds
+        mongo = Mongo()
+        lookup = wait_lookup(mongo, request_lookup(mongo, sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5]), timeout)
+        if lookup['status'] in ['pending', 'running']:
+            print("[WARN] Lookup {id} still {status} after {timeout} seconds".format(id=lookup['_id'], status=lookup['status'], timeout=timeout))
+            sys.exit(1)
+        print(json.dumps({'status': lookup['status'], 'done': lookup['done'].isoformat(), 'result': lookup.get('result')}, indent=2))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "supervise":
+        if len(sys.argv) >= 3:
+            update_concurrency = int(sys.argv[2])
+        Supervisor(update_concurrency).run()
     else:
         usage()
 
-main()
+if __name__ == '__main__':
+    main()